@@ -1,9 +1,10 @@
 # import omero
 # Need to pip install cython; pip install findmaxima2d
 import omero.scripts as scripts
-from omero.gateway import BlitzGateway, FileAnnotationWrapper
+from omero.gateway import (BlitzGateway, DatasetWrapper,
+                           FileAnnotationWrapper, ImageWrapper)
 from omero.rtypes import rlong, rstring  # , robject
-import omero.util.script_utils as script_utils
+from omero.sys import ParametersI
 import numpy as np
 from findmaxima2d import find_maxima, find_local_maxima
 from scipy import optimize
@@ -45,7 +46,6 @@ def fitBeads(peaks, image_stack, image_MIP, size, crop):
     '''
     Fit 2D Gaussian to MIP of each bead and fit z along central pixels
     '''
-    t = 0
     u = np.linspace(0, crop*2-1, crop*2)
     x, y = np.meshgrid(u, u)
     z_pts = np.linspace(0, size['z']-1, size['z'])
@@ -60,14 +60,14 @@ def fitBeads(peaks, image_stack, image_MIP, size, crop):
     fitz = np.zeros((no_beads, 4))
 
     for i in range(len(peaks)):
-        # crop out bead
+        # crop out bead, peaks are (y, x)
         sub = image_MIP[peaks[i, 0] - crop:peaks[i, 0] + crop,
                         peaks[i, 1] - crop:peaks[i, 1] + crop]
         p1 = [np.max(sub), crop, crop, 2, 2, 0, 100]
         p2 = [np.max(sub), size['z']/2, 1, 100]
         # find each axis of the max pixel
         print(peaks)
-        z_gauss = image_stack[peaks[0][0], peaks[0][1]]
+        z_gauss = image_stack[:, peaks[i, 0], peaks[i, 1]].astype(np.float64)
 
         try:
             popt, pcov = optimize.curve_fit(
@@ -75,18 +75,55 @@ def fitBeads(peaks, image_stack, image_MIP, size, crop):
             zpars, zcov = optimize.curve_fit(
                 f=gaussian, xdata=z_pts, ydata=z_gauss, p0=p2, bounds=bz)
             # read the fitted parameters to an array
-            fitxy[t, :] = popt
-            fitz[t, :] = zpars
+            fitxy[i, :] = popt
+            fitz[i, :] = zpars
         except RuntimeError:
             # if the algorithm cannot fit, instead of breaking we set the fitted parameters to NaN
             # fit[:,:,i] = 'NaN'
-            fitxy[t, :] = 'NaN'
-            fitz[t, :] = 'NaN'
+            fitxy[i, :] = 'NaN'
+            fitz[i, :] = 'NaN'
         data_fitted = twoD_Gaussian((x, y), *popt)
 
     return fitxy, fitz, peaks
 
 
+# Largest hypercube fetched in one request, in bytes
+DEFAULT_CHUNK_SIZE = 32 * 1024 * 1024
+
+PIXEL_TYPES = {'int8': np.int8, 'uint8': np.uint8,
+               'int16': np.int16, 'uint16': np.uint16,
+               'int32': np.int32, 'uint32': np.uint32,
+               'float': np.float32, 'double': np.float64}
+
+
+def get_stack(conn, pixels, the_c, the_t, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Z stack of one channel and timepoint as one (Z, Y, X) array in the
+    source pixel type, read in hypercubes of at most chunk_size bytes
+    """
+    pixel_type = pixels.getPixelsType().getValue().getValue()
+    # Sent big-endian by the server
+    dtype = np.dtype(PIXEL_TYPES[pixel_type]).newbyteorder('>')
+    size_x = pixels.getSizeX().getValue()
+    size_y = pixels.getSizeY().getValue()
+    size_z = pixels.getSizeZ().getValue()
+    stack = np.empty((size_z, size_y, size_x), dtype=dtype.newbyteorder('='))
+    step = max(1, chunk_size // (size_x * size_y * dtype.itemsize))
+    raw_pixel_store = conn.c.sf.createRawPixelsStore()
+    try:
+        raw_pixel_store.setPixelsId(pixels.getId().getValue(), True)
+        for first in range(0, size_z, step):
+            n = min(step, size_z - first)
+            raw = raw_pixel_store.getHypercube(
+                [0, 0, first, the_c, the_t], [size_x, size_y, n, 1, 1],
+                [1, 1, 1, 1, 1])
+            stack[first:first + n] = np.frombuffer(raw, dtype=dtype).reshape(
+                n, size_y, size_x)
+    finally:
+        raw_pixel_store.close()
+    return stack
+
+
 def getPeaks(image, script_params, conn):
     '''
     Load the image and process
@@ -101,12 +138,12 @@ def getPeaks(image, script_params, conn):
     size['y'] = image.getSizeY()
     size['z'] = image.getSizeZ()
 
-    pixels = image.getPrimaryPixels()
-    image_stack = np.zeros((size['x'], size['y'], size['z']))
-    for i in range(size['z']):
-        image_stack[:, :, i] = pixels.getPlane(i, c, t)
+    # Loaded with its pixels type by getImages
+    pixels = image._obj.getPrimaryPixels()
+    image_stack = get_stack(conn, pixels, c, t)
 
-    image_MIP = np.max(image_stack, axis=2)
+    # Small enough to convert for the peak finding
+    image_MIP = np.max(image_stack, axis=0).astype(np.float64)
 
     fig0 = plt.figure(figsize=(3, 3))
     plt.imshow(image_MIP)
@@ -131,8 +168,8 @@ def getPeaks(image, script_params, conn):
 
     Flag = np.zeros(len(peaks))
     for i in range(0, len(peaks)):
-        # first check if is an edge one
-        if (0 + d < peaks[i, 0] < size['x'] - d) and (0 + d < peaks[i, 1] < size['y'] - d):
+        # first check if is an edge one, peaks are (y, x)
+        if (0 + d < peaks[i, 0] < size['y'] - d) and (0 + d < peaks[i, 1] < size['x'] - d):
             for j in range(0, len(peaks)):
                 # ignore if the same coordinate
                 if i != j:
@@ -156,30 +193,70 @@ def getPeaks(image, script_params, conn):
     return peaks, image_stack, image_MIP, size, fig0, fig1, fig2
 
 
+# Number of IDs passed to one HQL query
+QUERY_CHUNK_SIZE = 500
+
+
+def chunks(ids, size=QUERY_CHUNK_SIZE):
+    """Split a list of IDs into lists of at most size IDs"""
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
 def getImages(conn, script_params):
     """
-    Get the images
+    Get the images, with their pixels, pixels type, parent datasets and
+    owners loaded in a few queries chunked by ID, so later lookups don't
+    go back to the server
     """
-    message = ""
-    objects, log_message = script_utils.get_objects(conn, script_params)
-    message += log_message
-    if not objects:
-        return None, message
-
-    data_type = script_params["Data_Type"]
-
-    if data_type == 'Dataset':
-        images = []
-        for ds in objects:
-            images.extend(list(ds.listChildren()))
-        if not images:
-            message += "No image found in dataset(s)"
-            return None, message
+    query_service = conn.getQueryService()
+    ids = script_params["IDs"]
+    if script_params["Data_Type"] == 'Dataset':
+        image_ids = []
+        for chunk in chunks(ids):
+            params = ParametersI()
+            params.addIds(chunk)
+            rows = query_service.projection(
+                "select l.child.id from DatasetImageLink l "
+                "where l.parent.id in (:ids) order by l.parent.id, l.child.id",
+                params, conn.SERVICE_OPTS)
+            image_ids.extend(row[0].getValue() for row in rows)
+        if not image_ids:
+            log("No image found in dataset(s)")
     else:
-        images = objects
+        image_ids = ids
+    loaded = {}
+    for chunk in chunks(list(set(image_ids))):
+        params = ParametersI()
+        params.addIds(chunk)
+        for obj in query_service.findAllByQuery(
+                "select distinct i from Image i "
+                "join fetch i.details.owner "
+                "join fetch i.pixels p join fetch p.pixelsType "
+                "left outer join fetch i.datasetLinks l "
+                "left outer join fetch l.parent d "
+                "left outer join fetch d.details.owner "
+                "where i.id in (:ids)", params, conn.SERVICE_OPTS):
+            loaded[obj.getId().getValue()] = obj
+    missing = len(set(image_ids) - set(loaded))
+    if missing:
+        log("%d image(s) not found" % missing)
+    # Keep the order of selection, once per image
+    images = []
+    for image_id in image_ids:
+        if image_id in loaded:
+            images.append(ImageWrapper(conn, loaded.pop(image_id)))
     return images
 
 
+def getDataset(conn, image):
+    """First parent dataset of an image loaded by getImages, or None"""
+    links = image._obj.copyDatasetLinks()
+    if not links:
+        return None
+    return DatasetWrapper(conn, links[0].getParent())
+
+
 def saveResultsToProject(scope, conn, dataset, Rayleigh, Wavelength, NA, acDate):
     project = conn.getObject("Project", dataset.getParent().getId())
     print(project.getId())
@@ -325,12 +402,14 @@ def runScript():
                 fig, axes = plt.subplots(3, 3, sharey=True)
 
                 for i in range(0, len(peaks)):
-                    # crop out bead
-                    sub = image_stack[
+                    # crop out bead as (y, x, z)
+                    sub = np.moveaxis(image_stack[
+                        :,
                         peaks[i, 0] - script_params["Crop"]:
                             peaks[i, 0] + script_params["Crop"] + 1,
                         peaks[i, 1] - script_params["Crop"]:
-                            peaks[i, 1] + script_params["Crop"] + 1, :]
+                            peaks[i, 1] + script_params["Crop"] + 1], 0, -1)
+                    sub = sub.astype(np.float64)
                     # remove background
                     sub = sub - np.mean(sub[0:5, 0:5, 0])
                     # find the maximum pixel
@@ -379,7 +458,7 @@ def runScript():
                                transform=firstPage.transFigure, size=24,
                                ha="center")
 
-                dataset = conn.getObject("Dataset", image.getParent().getId())
+                dataset = getDataset(conn, image)
                 print(dataset.getId())
                 if dataset.getParent() is not None:
                     df = saveResultsToProject(
@@ -2,8 +2,20 @@
 import omero
 import omero.scripts as scripts
 from omero.gateway import BlitzGateway
-from omero.rtypes import rlong, rstring
+from omero.rtypes import rlist, rlong, rstring
+from omero.sys import ParametersI
+from datetime import datetime
 import pandas as pd
+import hashlib
+from itertools import combinations
+from math import comb
+import io
+import time
+import numpy as np
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 '''
 Find duplicate images within same dataset and move to project for deletion
 '''
@@ -14,31 +26,639 @@ def log(data):
     print(data)
 
 
-def filter_comments(a):
-    if isinstance(a, str):
-        if a.startswith('regex'):
-            return False
+# Metadata columns and their dtypes
+COLUMNS = {'id': 'int64', 'fileset': 'Int64', 'Name': 'object',
+           'acDate': 'datetime64[ns]', 'sizeX': 'int64', 'sizeY': 'int64',
+           'sizeZ': 'int64', 'sizeT': 'int64', 'sizeC': 'int64',
+           'No. Annotate': 'int64', 'No. ROI': 'int64'}
+# Images are duplicates when all of these match
+KEY_COLUMNS = list(COLUMNS)[2:]
+
+
+# Number of IDs passed to one HQL query
+QUERY_CHUNK_SIZE = 500
+DUPLICATE_TAG = 'CAMDU Duplicate'
+FINGERPRINT_NS = "camdu.duplicate_fingerprint"
+# Annotations written by the CAMDU scripts themselves, which do not make
+# an image differ from its copies: content fingerprints and the results
+# cached by Find_in_focus_plane
+SCRIPT_NAMESPACES = [FINGERPRINT_NS, "camdu.focus_cache"]
+
+
+def chunks(ids, size=QUERY_CHUNK_SIZE):
+    """Split a list of IDs into lists of at most size IDs"""
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
+def countByImage(conn, query, image_ids, values=None):
+    """
+    Run a "select image id, count ... group by image id" query over the
+    images one chunk at a time, returning the counts by image ID. values
+    are any other named parameters of the query.
+    """
+    query_service = conn.getQueryService()
+    counts = {}
+    for chunk in chunks(image_ids):
+        params = ParametersI()
+        params.addIds(chunk)
+        for name, value in (values or {}).items():
+            params.add(name, value)
+        for row in query_service.projection(query, params,
+                                            conn.SERVICE_OPTS):
+            counts[row[0].getValue()] = row[1].getValue()
+    return counts
+
+
+def scanImages(conn, image_ids):
+    """
+    Metadata columns of the images, and the IDs of the images already
+    tagged as duplicates, from a few aggregate queries per chunk of IDs
+    """
+    query_service = conn.getQueryService()
+    rows = []
+    for chunk in chunks(image_ids):
+        params = ParametersI()
+        params.addIds(chunk)
+        rows.extend(query_service.projection(
+            "select i.id, fs.id, i.name, i.acquisitionDate, p.sizeX, "
+            "p.sizeY, p.sizeZ, p.sizeT, p.sizeC from Image i "
+            "join i.pixels p left outer join i.fileset fs "
+            "where i.id in (:ids) order by i.id", params, conn.SERVICE_OPTS))
+    columns = dict((name, []) for name in COLUMNS)
+    for row in rows:
+        values = [value.getValue() if value is not None else None
+                  for value in row]
+        acDate = values[3]
+        if acDate is not None:
+            acDate = datetime.fromtimestamp(acDate / 1000.0)
+        for name, value in zip(['id', 'fileset', 'Name', 'acDate', 'sizeX',
+                                'sizeY', 'sizeZ', 'sizeT', 'sizeC'],
+                               values[:3] + [acDate] + values[4:]):
+            columns[name].append(value)
+    image_ids = columns['id']
+    tagged = set()
+    for chunk in chunks(image_ids):
+        params = ParametersI()
+        params.addIds(chunk)
+        params.add("tag", rstring(DUPLICATE_TAG))
+        for row in query_service.projection(
+                "select distinct l.parent.id from ImageAnnotationLink l, "
+                "TagAnnotation a where a.id = l.child.id "
+                "and a.textValue = :tag and l.parent.id in (:ids)",
+                params, conn.SERVICE_OPTS):
+            tagged.add(row[0].getValue())
+    # Custom comments annotations
+    # (ignore autogenerated at import using regex, and our own tag and
+    # annotations)
+    annotations = countByImage(
+        conn, "select l.parent.id, count(l) from ImageAnnotationLink l "
+        "where l.parent.id in (:ids) group by l.parent.id", image_ids)
+    generated = countByImage(
+        conn, "select l.parent.id, count(l) from ImageAnnotationLink l, "
+        "TextAnnotation a where a.id = l.child.id "
+        "and a.textValue like 'regex%' "
+        "and l.parent.id in (:ids) group by l.parent.id", image_ids)
+    own = countByImage(
+        conn, "select l.parent.id, count(l) from ImageAnnotationLink l, "
+        "Annotation a where a.id = l.child.id and a.ns in (:ns) "
+        "and l.parent.id in (:ids) group by l.parent.id", image_ids,
+        {'ns': rlist([rstring(ns) for ns in SCRIPT_NAMESPACES])})
+    rois = countByImage(
+        conn, "select r.image.id, count(r) from Roi r "
+        "where r.image.id in (:ids) group by r.image.id", image_ids)
+    columns['No. Annotate'] = [
+        annotations.get(i, 0) - generated.get(i, 0) - own.get(i, 0) -
+        (i in tagged)
+        for i in image_ids]
+    columns['No. ROI'] = [rois.get(i, 0) for i in image_ids]
+    return columns, tagged
+
+
+def toFrame(columns):
+    """DataFrame with the COLUMNS dtypes from a dict of column lists"""
+    return pd.DataFrame(columns, columns=list(COLUMNS)).astype(COLUMNS)
+
+
+def rowKeys(metadata, key_columns=KEY_COLUMNS):
+    """
+    One hash per row of the key columns, so duplicates can be grouped on a
+    single integer column rather than by comparing the columns themselves
+    """
+    return pd.util.hash_pandas_object(metadata[key_columns], index=False)
+
+
+# Number of images whose metadata is scanned at once
+SCAN_CHUNK_SIZE = 10000
+
+
+def getScopes(conn, script_params):
+    """
+    Yield (description, image IDs) of each set of images searched for
+    duplicates: each dataset on its own, or every image of each project
+    or group
+    """
+    query_service = conn.getQueryService()
+    data_type = script_params["Data_Type"]
+    queries = {
+        'Dataset': "select l.child.id from DatasetImageLink l "
+                   "where l.parent.id = :id",
+        'Project': "select distinct l.child.id from DatasetImageLink l, "
+                   "ProjectDatasetLink pl where pl.child.id = l.parent.id "
+                   "and pl.parent.id = :id",
+        'Group': "select i.id from Image i where i.details.group.id = :id"}
+    for id in script_params["IDs"]:
+        if data_type == 'Group':
+            # Queries and tags then stay within the group
+            conn.SERVICE_OPTS.setOmeroGroup(id)
+        params = ParametersI()
+        params.addId(id)
+        rows = query_service.projection(queries[data_type], params,
+                                        conn.SERVICE_OPTS)
+        yield ("%s %s" % (data_type, id),
+               sorted(row[0].getValue() for row in rows))
+
+
+def getDatasets(conn, image_ids):
+    """IDs of the datasets holding each image"""
+    query_service = conn.getQueryService()
+    datasets = {}
+    for chunk in chunks(image_ids):
+        params = ParametersI()
+        params.addIds(chunk)
+        for row in query_service.projection(
+                "select l.child.id, l.parent.id from DatasetImageLink l "
+                "where l.child.id in (:ids)", params, conn.SERVICE_OPTS):
+            datasets.setdefault(row[0].getValue(), set()).add(
+                row[1].getValue())
+    return datasets
+
+
+def reportClusters(conn, keys):
+    """Log the groups of duplicates whose images are in several datasets"""
+    clusters = keys[keys['key'].duplicated(keep=False)]
+    datasets = getDatasets(conn, clusters['id'].tolist())
+    spanning = 0
+    for key, cluster in clusters.groupby('key', sort=False):
+        ids = cluster['id'].tolist()
+        cluster_datasets = set()
+        for image_id in ids:
+            cluster_datasets.update(datasets.get(image_id, ()))
+        if len(cluster_datasets) > 1:
+            spanning += 1
+            log("Images %s are duplicates across datasets %s"
+                % (", ".join(str(i) for i in ids),
+                   ", ".join(str(d) for d in sorted(cluster_datasets))))
+    log("%d duplicate group(s) span several datasets" % spanning)
+
+
+# Edge length of the tiles hashed for content fingerprints
+CONTENT_TILE_SIZE = 128
+def contentInfo(conn, image_ids):
+    """
+    Pixels, their last update and a key of the fileset's stored checksums
+    and series, by image ID. The key is None when the image has no
+    fileset or the checksums are not all known.
+    """
+    query_service = conn.getQueryService()
+    info = {}
+    for chunk in chunks(image_ids):
+        params = ParametersI()
+        params.addIds(chunk)
+        for row in query_service.projection(
+                "select i.id, p.id, p.details.updateEvent.id, i.series, "
+                "fs.id, p.sizeX, p.sizeY, p.sizeZ, p.sizeC, p.sizeT, "
+                "p.pixelsType.value from Image i join i.pixels p "
+                "left outer join i.fileset fs where i.id in (:ids)",
+                params, conn.SERVICE_OPTS):
+            values = [value.getValue() if value is not None else None
+                      for value in row]
+            info[values[0]] = {
+                'pixels': values[1], 'event': values[2],
+                'series': values[3], 'fileset': values[4],
+                'sizes': values[5:10], 'type': values[10], 'files': None}
+    filesets = list(set(i['fileset'] for i in info.values()
+                        if i['fileset'] is not None))
+    checksums = {}
+    for chunk in chunks(filesets):
+        params = ParametersI()
+        params.addIds(chunk)
+        for row in query_service.projection(
+                "select e.fileset.id, f.hash from FilesetEntry e "
+                "join e.originalFile f where e.fileset.id in (:ids)",
+                params, conn.SERVICE_OPTS):
+            checksum = row[1].getValue() if row[1] is not None else None
+            checksums.setdefault(row[0].getValue(), []).append(checksum)
+    for i in info.values():
+        hashes = checksums.get(i['fileset'])
+        if hashes and None not in hashes:
+            key = "%s:%s" % (i['series'], ",".join(sorted(hashes)))
+            i['files'] = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return info
+
+
+def pixelFingerprint(raw_pixel_store, info):
+    """
+    Hash of the sizes and pixel type of an image and of a few tiles along
+    the diagonal of the middle plane of each channel
+    """
+    size_x, size_y, size_z, size_c, size_t = info['sizes']
+    digest = hashlib.sha1(("%s:%s" % (info['sizes'], info['type'])).encode(
+        'utf-8'))
+    raw_pixel_store.setPixelsId(info['pixels'], True)
+    w = min(CONTENT_TILE_SIZE, size_x)
+    h = min(CONTENT_TILE_SIZE, size_y)
+    for c in range(size_c):
+        for fraction in (0.25, 0.5, 0.75):
+            x = min(int(fraction * size_x), size_x - w)
+            y = min(int(fraction * size_y), size_y - h)
+            digest.update(raw_pixel_store.getTile(
+                size_z // 2, c, size_t // 2, x, y, w, h))
+    return digest.hexdigest()
+
+
+def findFingerprints(conn, image_ids):
+    """
+    Fingerprint annotation of each image, with the update event and file
+    key it was computed for, looked up in one query per chunk
+    """
+    query_service = conn.getQueryService()
+    found = {}
+    for chunk in chunks(image_ids):
+        params = ParametersI()
+        params.addIds(chunk)
+        params.add("ns", rstring(FINGERPRINT_NS))
+        for link in query_service.findAllByQuery(
+                "select l from ImageAnnotationLink l "
+                "join fetch l.child a left outer join fetch a.mapValue "
+                "where a.ns = :ns and l.parent.id in (:ids)",
+                params, conn.SERVICE_OPTS):
+            ann = link.getChild()
+            entries = dict((nv.name, nv.value) for nv in ann.getMapValue())
+            found[link.getParent().getId().getValue()] = {
+                'annotation': ann,
+                'event': entries.get('update_event'),
+                'files': entries.get('files'),
+                'fingerprint': entries.get('fingerprint')}
+    return found
+
+
+def findFileFingerprints(conn, file_keys):
+    """
+    Fingerprint already stored for any image with each of the file keys,
+    looked up in one query per chunk
+    """
+    query_service = conn.getQueryService()
+    found = {}
+    for chunk in chunks(list(file_keys)):
+        params = ParametersI()
+        params.add("ns", rstring(FINGERPRINT_NS))
+        params.add("values", rlist([rstring(key) for key in chunk]))
+        for row in query_service.projection(
+                "select f.value, fp.value from MapAnnotation a "
+                "join a.mapValue f join a.mapValue fp "
+                "where a.ns = :ns and f.name = 'files' "
+                "and fp.name = 'fingerprint' and f.value in (:values)",
+                params, conn.SERVICE_OPTS):
+            found[row[0].getValue()] = row[1].getValue()
+    return found
+
+
+def fingerprintObject(image_id, image, fingerprint, stored):
+    """
+    Unsaved annotation or link recording the fingerprint of an image, the
+    existing annotation being updated in place when there is one
+    """
+    values = [omero.model.NamedValue('fingerprint', fingerprint),
+              omero.model.NamedValue('update_event', str(image['event']))]
+    if image['files'] is not None:
+        values.append(omero.model.NamedValue('files', image['files']))
+    if stored is not None:
+        stored['annotation'].setMapValue(values)
+        return stored['annotation']
+    ann = omero.model.MapAnnotationI()
+    ann.setNs(rstring(FINGERPRINT_NS))
+    ann.setMapValue(values)
+    link = omero.model.ImageAnnotationLinkI()
+    link.setParent(omero.model.ImageI(image_id, False))
+    link.setChild(ann)
+    return link
+
+
+def updateFingerprints(conn, image_ids):
+    """
+    Content fingerprint of each image, kept on the server as a map
+    annotation so only images that are new or whose pixels changed since
+    are hashed. Images whose file key already has a fingerprint reuse it
+    without reading any pixels.
+    """
+    info = contentInfo(conn, image_ids)
+    stored = findFingerprints(conn, list(info))
+    fingerprints = {}
+    for image_id, entry in stored.items():
+        if entry['event'] == str(info[image_id]['event']):
+            fingerprints[image_id] = entry['fingerprint']
+    stale = [image_id for image_id in info if image_id not in fingerprints]
+    if not stale:
+        return fingerprints
+    by_files = findFileFingerprints(
+        conn, set(info[image_id]['files'] for image_id in stale
+                  if info[image_id]['files'] is not None))
+    objects = []
+    hashed = 0
+    raw_pixel_store = conn.c.sf.createRawPixelsStore()
+    try:
+        for image_id in stale:
+            image = info[image_id]
+            fingerprint = by_files.get(image['files'])
+            if fingerprint is None:
+                fingerprint = pixelFingerprint(raw_pixel_store, image)
+                hashed += 1
+                if image['files'] is not None:
+                    by_files[image['files']] = fingerprint
+            objects.append(fingerprintObject(image_id, image, fingerprint,
+                                             stored.get(image_id)))
+            fingerprints[image_id] = fingerprint
+    finally:
+        raw_pixel_store.close()
+        # Fingerprints found so far are saved even if a later image failed
+        update_service = conn.getUpdateService()
+        for chunk in chunks(objects):
+            try:
+                update_service.saveArray(chunk, conn.SERVICE_OPTS)
+            except omero.ServerError as e:
+                # Such as other users' images in a read-only group
+                log("Could not save %d fingerprint(s), they will be "
+                    "computed again next time: %s" % (len(chunk), e))
+    log("Fingerprinted %d image(s), %d from their pixels"
+        % (len(stale), hashed))
+    return fingerprints
+
+
+# Thumbnails fetched per request and their longest side
+THUMBNAIL_BATCH_SIZE = 100
+THUMBNAIL_SIZE = 64
+
+
+def dHash(image):
+    """64 bit difference hash: is each pixel brighter than its neighbour"""
+    pixels = np.asarray(image.convert('L').resize((9, 8), Image.LANCZOS),
+                        dtype=np.float64)
+    return bitsToInt(pixels[:, 1:] > pixels[:, :-1])
+
+
+def pHash(image):
+    """
+    64 bit perceptual hash: is each of the lowest 8x8 DCT frequencies above
+    their median
+    """
+    pixels = np.asarray(image.convert('L').resize((32, 32), Image.LANCZOS),
+                        dtype=np.float64)
+    n = np.arange(32)
+    dct = np.cos(np.pi * (2 * n[np.newaxis, :] + 1) * n[:, np.newaxis] / 64)
+    low = (dct.dot(pixels).dot(dct.T))[:8, :8]
+    # The DC term only tells how bright the image is
+    return bitsToInt(low > np.median(low.ravel()[1:]))
+
+
+def bitsToInt(bits):
+    value = 0
+    for bit in bits.ravel():
+        value = (value << 1) | int(bit)
+    return value
+
+
+PERCEPTUAL_HASHES = {'dHash': dHash, 'pHash': pHash}
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+# Bits in every perceptual hash
+HASH_BITS = 64
+
+
+def hashBands(max_distance, count):
+    """
+    Masks splitting the hash bits into bands, and for each band the bit
+    flips to probe. Two hashes at most max_distance apart differ by at
+    most max_distance // bands bits in one band, so probing those flips
+    finds every match. The number of bands is the one reading the fewest
+    table entries for count uniformly spread hashes.
+    """
+    best = None
+    for bands in range(1, min(max_distance + 1, HASH_BITS) + 1):
+        radius = max_distance // bands
+        bounds = [HASH_BITS * i // bands for i in range(bands + 1)]
+        cost = 0
+        for start, stop in zip(bounds[:-1], bounds[1:]):
+            probes = sum(comb(stop - start, k) for k in range(radius + 1))
+            cost += probes * (1 + count / 2.0 ** (stop - start))
+        if best is None or cost < best[0]:
+            best = (cost, bounds, radius)
+    cost, bounds, radius = best
+    masks = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        flips = [sum(1 << bit for bit in bits)
+                 for k in range(radius + 1)
+                 for bits in combinations(range(start, stop), k)]
+        masks.append((((1 << (stop - start)) - 1) << start, flips))
+    return masks
+
+
+def perceptualHashes(conn, image_ids, hash_name):
+    """
+    Perceptual hash of the thumbnail of each image, with the thumbnails
+    rendered by the server and fetched in batches
+    """
+    hashes = {}
+    for chunk in chunks(image_ids, THUMBNAIL_BATCH_SIZE):
+        thumbnails = conn.getThumbnailSet(chunk, max_size=THUMBNAIL_SIZE)
+        for image_id, data in thumbnails.items():
+            try:
+                hashes[image_id] = PERCEPTUAL_HASHES[hash_name](
+                    Image.open(io.BytesIO(data)))
+            except (IOError, ValueError) as e:
+                log("No thumbnail for image %s: %s" % (image_id, e))
+    return hashes
+
+
+def nearClusters(items, max_distance):
+    """
+    Key of each (item, hash), taken in the order the images are to be
+    kept, and the number of hashes compared. The key is the closest
+    earlier kept item at most max_distance away, or else the item itself,
+    which is then kept. Every image of a cluster is so within max_distance
+    of the one kept, never only linked to it through a chain of others.
+    """
+    items = list(items)
+    if max_distance >= HASH_BITS:
+        # Every pair of hashes is close enough
+        first = items[0][0] if items else None
+        return dict((item, first) for item, value in items), 0
+    masks = hashBands(max_distance, len(items))
+    # Kept items by the value of each band
+    tables = [{} for mask in masks]
+    keys = {}
+    comparisons = 0
+    for item, value in items:
+        candidates = {}
+        for (mask, flips), table in zip(masks, tables):
+            for flip in flips:
+                for match, match_value in table.get((value ^ flip) & mask,
+                                                    []):
+                    candidates[match] = match_value
+        best = None
+        for match, match_value in candidates.items():
+            comparisons += 1
+            distance = hamming(value, match_value)
+            if distance <= max_distance and (best is None
+                                             or distance < best[0]):
+                best = (distance, match)
+        if best is not None:
+            keys[item] = best[1]
+            continue
+        keys[item] = item
+        for (mask, flips), table in zip(masks, tables):
+            table.setdefault(value & mask, []).append((item, value))
+    return keys, comparisons
+
+
+# Synthetic images hashed by each benchmark run
+BENCHMARK_SIZES = [1000, 10000, 100000]
+
+
+def syntheticImages(count, rng):
+    """
+    count synthetic images, the second half being altered copies of the
+    first
+    """
+    images = []
+    for i in range(count // 2):
+        base = Image.fromarray((rng.random((6, 6)) * 255).astype(np.uint8))
+        images.append(base.resize((96, 96), Image.BICUBIC))
+    for i, original in enumerate(list(images)):
+        change = i % 4
+        if change == 0:
+            # Recompressed
+            buffer = io.BytesIO()
+            original.save(buffer, format='JPEG', quality=30)
+            copy = Image.open(io.BytesIO(buffer.getvalue()))
+        elif change == 1:
+            # Lower bit depth and brightness
+            pixels = np.asarray(original, dtype=np.float64) * 0.8
+            copy = Image.fromarray((pixels // 16 * 16).astype(np.uint8))
+        elif change == 2:
+            # Cropped by 5% and scaled back
+            copy = original.crop((5, 5, 91, 91)).resize((96, 96))
         else:
-            return True
-    else:
-        return True
+            # Noisy
+            pixels = np.asarray(original, dtype=np.float64)
+            pixels += rng.normal(0, 8, pixels.shape)
+            copy = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+        images.append(copy)
+    return images
+
+
+def benchmarkPerceptual(hash_name, max_distance, sizes=BENCHMARK_SIZES):
+    """
+    Log how well and how fast near duplicates are found among synthetic
+    images of each size, half of them altered copies of the other half
+    """
+    rng = np.random.default_rng(0)
+    hash_function = PERCEPTUAL_HASHES[hash_name]
+    for count in sizes:
+        images = syntheticImages(count, rng)
+        start = time.time()
+        items = [(i, hash_function(image.resize(
+            (THUMBNAIL_SIZE, THUMBNAIL_SIZE))))
+            for i, image in enumerate(images)]
+        hashed = time.time()
+        clusters, comparisons = nearClusters(items, max_distance)
+        searched = time.time()
+        half = count // 2
+        found = sum(clusters[i] == clusters[i + half] for i in range(half))
+        merged = len(set(clusters[i] for i in range(half)))
+        log("Benchmark %s, Max_Distance %d, %d images: %d of %d copies "
+            "found, %d originals wrongly merged, hashing %.2fs, search "
+            "%.2fs with %d comparisons instead of %d"
+            % (hash_name, max_distance, 2 * half, found, half,
+               half - merged, hashed - start, searched - hashed,
+               comparisons, count * (count - 1) // 2))
+
+
+# Tag links saved per call
+LINK_BATCH_SIZE = 1000
+
+
+def getDuplicateTag(conn):
+    """The CAMDU Duplicate tag, created if it does not exist yet"""
+    tag_ann = conn.getObject(
+        "TagAnnotation",
+        attributes={"textValue": DUPLICATE_TAG}
+        )
+    if not tag_ann:
+        tag_ann = omero.gateway.TagAnnotationWrapper(conn)
+        tag_ann.setValue(DUPLICATE_TAG)
+        tag_ann.setDescription(
+            "Duplicate image to be deleted by CAMDU")
+        tag_ann.save()
+    return tag_ann
+
+
+def tagImages(conn, tag_ann, image_ids):
+    """Link the tag to the images, saving the links in batches"""
+    update_service = conn.getUpdateService()
+    for chunk in chunks(image_ids, LINK_BATCH_SIZE):
+        links = []
+        for image_id in chunk:
+            link = omero.model.ImageAnnotationLinkI()
+            link.setParent(omero.model.ImageI(image_id, False))
+            link.setChild(omero.model.TagAnnotationI(tag_ann.getId(), False))
+            links.append(link)
+        update_service.saveArray(links, conn.SERVICE_OPTS)
 
 
 def runScript():
-    data_types = [rstring('Dataset')]
+    data_types = [rstring('Dataset'), rstring('Project'), rstring('Group')]
+    modes = [rstring('Metadata'), rstring('Content'), rstring('Perceptual')]
+    hashes = [rstring(name) for name in PERCEPTUAL_HASHES]
     client = scripts.client(
         "Find_Duplicates.py",
         """
-        Find duplicate images within a dataset and tag with "CAMDU Duplicate"
-        so admin can delete them
+        Find duplicate images within a dataset, or across every dataset of
+        a project or group, and tag with "CAMDU Duplicate" so admin can
+        delete them
         """,
         scripts.String(
             "Data_Type", optional=False, grouping="1",
-            description="Choose Dataset", values=data_types,
+            description="Search each dataset on its own, or all images of "
+            "each project or group together", values=data_types,
             default="Dataset"),
         scripts.List(
             "IDs", optional=False, grouping="2",
-            description="List of Dataset IDs to process.").ofType(rlong(0)),
+            description="List of Dataset, Project or Group IDs to "
+            "process.").ofType(rlong(0)),
+        scripts.String(
+            "Mode", optional=False, grouping="3", values=modes,
+            default="Metadata",
+            description="Metadata compares names, acquisition dates, sizes "
+            "and annotation and ROI counts. Content compares a fingerprint "
+            "of the stored file checksums or of sampled pixels, saved on each "
+            "image so only new or changed images are hashed again. Perceptual "
+            "finds near duplicates from a hash of their thumbnails"),
+        scripts.Int(
+            "Max_Distance", grouping="4", min=0, max=64, default=6,
+            description="Most bits two perceptual hashes can differ by for "
+            "the images to be near duplicates"),
+        scripts.String(
+            "Hash", grouping="5", values=hashes, default="dHash",
+            description="Perceptual hash of the thumbnails"),
+        scripts.Bool(
+            "Benchmark", grouping="6", default=False,
+            description="Only log how well and how fast the perceptual "
+            "hash finds altered copies among synthetic images"),
         version="0.0",
         authors=["Laura Cooper", "CAMDU"],
         institutions=["University of Warwick"],
@@ -47,59 +667,74 @@ def runScript():
     try:
         conn = BlitzGateway(client_obj=client)
         script_params = client.getInputs(unwrap=True)
-        roi_service = conn.getRoiService()
-
-        for id in script_params["IDs"]:
-            dataset = conn.getObject("Dataset", id)
-            colNames = ['id', 'fileset', 'Name', 'acDate', 'sizeX', 'sizeY',
-                        'sizeZ', 'sizeT', 'sizeC', 'No. Annotate', 'No. ROI']
-            metadata = pd.DataFrame(columns=colNames)
-            for image in dataset.listChildren():
-                # Get custom comments annotations
-                # (ignore autogenerated at import using regex)
-                anns = [ann.getValue() for ann in image.listAnnotations()
-                        if filter_comments(ann.getValue())]
-                if 'CAMDU Duplicate' in anns:
-                    log("""CAMDU Duplicate tag found, delete images or
-                        remove tags before re-running""")
-                    client.closeSession()
-                    exit()
-                findRois = roi_service.findByImage(image.getId(), None)
-                roiIds = [roi.getId().getValue() for roi in findRois.rois]
-
-                image_data = pd.DataFrame(
-                    data={'id': image.getId(),
-                          'fileset': image.getFileset().getId(),
-                          'Name': image.getName(),
-                          'acDate': image.getAcquisitionDate(),
-                          'sizeX': image.getSizeX(),
-                          'sizeY': image.getSizeY(),
-                          'sizeZ': image.getSizeZ(),
-                          'sizeT': image.getSizeT(),
-                          'sizeC': image.getSizeC(),
-                          'No. Annotate': len(anns),
-                          'No. ROI':  len(roiIds)}, index=[0])
-                metadata = metadata._append(image_data)
+        content = script_params["Mode"] == 'Content'
+        perceptual = script_params["Mode"] == 'Perceptual'
+        hash_name = script_params.get("Hash", "dHash")
+        max_distance = script_params.get("Max_Distance", 6)
+        if (perceptual or script_params.get("Benchmark")) and Image is None:
+            log("Perceptual hashes need Pillow, which is not installed")
+            return
+        if script_params.get("Benchmark"):
+            benchmarkPerceptual(hash_name, max_distance)
+            return
+
+        for scope, image_ids in getScopes(conn, script_params):
+            log("Searching %d image(s) of %s" % (len(image_ids), scope))
+            # Only the ID, fileset and key hash of each image are kept
+            keys = []
+            # Images tagged by an earlier run are not tagged again
+            tagged = set()
+            for image_chunk in chunks(image_ids, SCAN_CHUNK_SIZE):
+                columns, chunk_tagged = scanImages(conn, image_chunk)
+                tagged.update(chunk_tagged)
+                metadata = toFrame(columns)
+                key_columns = KEY_COLUMNS
+                if content:
+                    fingerprints = updateFingerprints(conn, columns['id'])
+                    metadata['fingerprint'] = metadata['id'].map(
+                        fingerprints)
+                    key_columns = ['fingerprint']
+                if perceptual:
+                    # Hashes for now, replaced by their cluster below
+                    hashes = perceptualHashes(conn, columns['id'], hash_name)
+                    keys.append(pd.DataFrame({
+                        'id': metadata['id'], 'fileset': metadata['fileset'],
+                        'key': pd.Series(
+                            [hashes.get(i) for i in columns['id']],
+                            index=metadata.index, dtype=object)}))
+                    continue
+                keys.append(pd.DataFrame({
+                    'id': metadata['id'], 'fileset': metadata['fileset'],
+                    'key': rowKeys(metadata, key_columns)}))
+            if not keys:
+                log('No duplicates found')
+                continue
+            metadata = pd.concat(keys, ignore_index=True)
             # Sort metadata by filesets to images from same fileset are tagged
             # Otherwise they can't be deleted
-            metadata = metadata.sort_values(by='fileset')
+            metadata = metadata.sort_values(by='fileset', kind='stable')
+            if perceptual:
+                # Images without a thumbnail are left on their own. Images
+                # are clustered in the order they are kept below.
+                metadata = metadata.dropna(subset=['key'])
+                clusters, comparisons = nearClusters(
+                    zip(metadata['id'].tolist(),
+                        [int(key) for key in metadata['key']]), max_distance)
+                metadata['key'] = metadata['id'].map(clusters)
+                log("%d hash comparisons instead of %d"
+                    % (comparisons, len(metadata) * (len(metadata) - 1) // 2))
             # Remove unique acquisition dates
-            mask = metadata.duplicated(subset=colNames[2::], keep='first')
+            mask = metadata['key'].duplicated(keep='first')
+            if script_params["Data_Type"] != 'Dataset':
+                reportClusters(conn, metadata)
             if not metadata[mask].empty:
                 log('Duplicates found')
-                tag_ann = conn.getObject(
-                    "TagAnnotation",
-                    attributes={"textValue": "CAMDU Duplicate"}
-                    )
-                if not tag_ann:
-                    tag_ann = omero.gateway.TagAnnotationWrapper(conn)
-                    tag_ann.setValue("CAMDU Duplicate")
-                    tag_ann.setDescription(
-                        "Duplicate image to be deleted by CAMDU")
-                    tag_ann.save()
-                for id in metadata[mask]['id']:
-                    image = conn.getObject("Image", id)
-                    image.linkAnnotation(tag_ann)
+                duplicates = metadata[mask]['id'].tolist()
+                new = [i for i in duplicates if i not in tagged]
+                if new:
+                    tagImages(conn, getDuplicateTag(conn), new)
+                log("Tagged %d duplicate(s), %d already tagged"
+                    % (len(new), len(duplicates) - len(new)))
             else:
                 log('No duplicates found')
     finally:
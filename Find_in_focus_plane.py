@@ -1,10 +1,18 @@
 # import the omero package and the omero.scripts package.
 import omero
 import omero.scripts as scripts
-from omero.gateway import BlitzGateway, DatasetWrapper
+from omero.gateway import BlitzGateway, DatasetWrapper, ImageWrapper
 from omero.rtypes import rlong, rstring, robject
+from omero.sys import ParametersI
 import omero.util.script_utils as script_utils
 import numpy as np
+import csv
+import hashlib
+import io
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 '''
 Slow, low memory usage
 '''
@@ -14,28 +22,75 @@ def log(data):
     """Handle logging or printing in one place."""
     print(data)
 
+# Number of IDs passed to one HQL query
+QUERY_CHUNK_SIZE = 500
+
+
+def chunks(ids, size=QUERY_CHUNK_SIZE):
+    """Split a list of IDs into lists of at most size IDs"""
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
+
+
 def getImages(conn, script_params):
     """
-    Get the images
+    Get the images, with their pixels, pixels type, parent datasets and
+    owners loaded in a few queries chunked by ID, so later lookups don't
+    go back to the server
     """
-    message = ""
-    objects, log_message = script_utils.get_objects(conn, script_params)
-    message += log_message
-    if not objects:
-        return None, message
+    query_service = conn.getQueryService()
+    ids = script_params["IDs"]
+    if script_params["Data_Type"] == 'Dataset':
+        image_ids = []
+        for chunk in chunks(ids):
+            params = ParametersI()
+            params.addIds(chunk)
+            rows = query_service.projection(
+                "select l.child.id from DatasetImageLink l "
+                "where l.parent.id in (:ids) order by l.parent.id, l.child.id",
+                params, conn.SERVICE_OPTS)
+            image_ids.extend(row[0].getValue() for row in rows)
+        if not image_ids:
+            log("No image found in dataset(s)")
+    else:
+        image_ids = ids
+    loaded = {}
+    for chunk in chunks(list(set(image_ids))):
+        params = ParametersI()
+        params.addIds(chunk)
+        for obj in query_service.findAllByQuery(
+                "select distinct i from Image i "
+                "join fetch i.details.owner "
+                "join fetch i.pixels p join fetch p.pixelsType "
+                "left outer join fetch i.datasetLinks l "
+                "left outer join fetch l.parent d "
+                "left outer join fetch d.details.owner "
+                "where i.id in (:ids)", params, conn.SERVICE_OPTS):
+            loaded[obj.getId().getValue()] = obj
+    missing = len(set(image_ids) - set(loaded))
+    if missing:
+        log("%d image(s) not found" % missing)
+    # Keep the order of selection, once per image
+    images = []
+    for image_id in image_ids:
+        if image_id in loaded:
+            images.append(ImageWrapper(conn, loaded.pop(image_id)))
+    return images
 
-    data_type = script_params["Data_Type"]
 
-    if data_type == 'Dataset':
-        images = []
-        for ds in objects:
-            images.extend(list(ds.listChildren()))
-        if not images:
-            message += "No image found in dataset(s)"
-            return None, message
+def getDatasets(conn, image, selected=None):
+    """
+    Parent datasets of an image loaded by getImages that are among the
+    selected dataset IDs, or its first parent dataset when none were
+    selected
+    """
+    parents = [link.getParent() for link in image._obj.copyDatasetLinks()]
+    if selected is None:
+        parents = parents[:1]
     else:
-        images = objects
-    return images
+        parents = [parent for parent in parents
+                   if parent.getId().getValue() in selected]
+    return [DatasetWrapper(conn, parent) for parent in parents]
 
 
 def get_plane(raw_pixel_store, pixels, the_z, the_c, the_t):
@@ -44,26 +99,537 @@ def get_plane(raw_pixel_store, pixels, the_z, the_c, the_t):
     raw_pixel_store.setPixelsId(pixels_id, True)
     return script_utils.download_plane(raw_pixel_store, pixels, the_z, the_c, the_t)
 
-    
-def stdCalculator(channel,raw_pixel_store, pixels, sizeZ):
+
+# Largest hypercube fetched in one request, in bytes
+DEFAULT_CHUNK_SIZE = 32 * 1024 * 1024
+
+PIXEL_TYPES = {'int8': np.int8, 'uint8': np.uint8,
+               'int16': np.int16, 'uint16': np.uint16,
+               'int32': np.int32, 'uint32': np.uint32,
+               'float': np.float32, 'double': np.float64}
+
+
+def get_dtype(pixels):
+    """Big-endian numpy dtype of the pixels, as sent by the server"""
+    pixel_type = pixels.getPixelsType().getValue().getValue()
+    return np.dtype(PIXEL_TYPES[pixel_type]).newbyteorder('>')
+
+
+def get_stack(raw_pixel_store, pixels, the_c, the_t, Z=None,
+              chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield the planes Z[0] to Z[1]-1 (the whole stack by default) of one
+    channel and timepoint as (n, h, w) float arrays, fetching as many
+    planes per request as fit in chunk_size bytes once converted to float.
+    Store must already be bound to the pixels.
+    """
+    dtype = get_dtype(pixels)
+    size_x = pixels.getSizeX().getValue()
+    size_y = pixels.getSizeY().getValue()
+    if Z is None:
+        Z = [0, pixels.getSizeZ().getValue()]
+    step = max(1, chunk_size // (size_x * size_y * 8))
+    for first in range(Z[0], Z[1], step):
+        n = min(step, Z[1] - first)
+        raw = raw_pixel_store.getHypercube(
+            [0, 0, first, the_c, the_t], [size_x, size_y, n, 1, 1],
+            [1, 1, 1, 1, 1])
+        stack = np.frombuffer(raw, dtype=dtype).reshape(n, size_y, size_x)
+        yield stack.astype(np.float64)
+
+
+def zRuns(zs):
+    """[start, stop) of each run of consecutive planes in the sorted zs"""
+    runs = []
+    for z in zs:
+        if runs and runs[-1][1] == z:
+            runs[-1][1] = z + 1
+        else:
+            runs.append([z, z + 1])
+    return runs
+
+
+def get_planes(raw_pixel_store, pixels, the_c, the_t, zs):
+    """
+    Yield (first z, stack) for the sorted planes zs, reading each run of
+    consecutive planes with get_stack
+    """
+    for Z in zRuns(zs):
+        first = Z[0]
+        for stack in get_stack(raw_pixel_store, pixels, the_c, the_t, Z):
+            yield first, stack
+            first += len(stack)
+
+
+# Edge length of the tiles read when Sampling is set
+SAMPLE_TILE_SIZE = 256
+
+
+def sampleTiles(pixels, count, tile_size=SAMPLE_TILE_SIZE):
+    """
+    (x, y, w, h) of up to count tiles spread in a grid over the plane,
+    row by row. Planes too small for separate tiles give fewer tiles.
+    """
+    size_x = pixels.getSizeX().getValue()
+    size_y = pixels.getSizeY().getValue()
+    rows = max(1, int(round(np.sqrt(count))))
+    cols = int(np.ceil(count / float(rows)))
+    w = min(tile_size, size_x)
+    h = min(tile_size, size_y)
+    tiles = []
+    for row in range(rows):
+        y = int((row + 0.5) * size_y / rows - h / 2.0)
+        for col in range(cols):
+            x = int((col + 0.5) * size_x / cols - w / 2.0)
+            tile = (min(max(x, 0), size_x - w),
+                    min(max(y, 0), size_y - h), w, h)
+            if tile not in tiles:
+                tiles.append(tile)
+    return tiles[:count]
+
+
+def get_tiles(raw_pixel_store, pixels, the_c, the_t, zs, tiles,
+              chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield (first z, stack) for the sorted planes zs, where stack holds the
+    tiles of each plane as an (n, tiles, h, w) float array. Each tile is
+    read with getHypercube over runs of consecutive planes, as many planes
+    per request as fit in chunk_size bytes for all tiles once converted.
+    """
+    dtype = get_dtype(pixels)
+    w, h = tiles[0][2:]
+    step = max(1, chunk_size // (len(tiles) * w * h * 8))
+    for Z in zRuns(zs):
+        for first in range(Z[0], Z[1], step):
+            n = min(step, Z[1] - first)
+            stack = np.stack([
+                np.frombuffer(raw_pixel_store.getHypercube(
+                    [x, y, first, the_c, the_t], [w, h, n, 1, 1],
+                    [1, 1, 1, 1, 1]), dtype=dtype).reshape(n, h, w)
+                for x, y, w, h in tiles], axis=1)
+            yield first, stack.astype(np.float64)
+
+
+# Focus metrics, each taking an (n, h, w) float stack and returning one
+# value per plane, higher meaning sharper
+
+def standardDeviation(stack):
+    return stack.std(axis=(1, 2))
+
+
+def normalisedVariance(stack):
+    """Variance divided by mean, so brighter planes are not favoured"""
+    mean = stack.mean(axis=(1, 2))
+    var = stack.var(axis=(1, 2))
+    return np.divide(var, mean, out=np.zeros_like(var), where=mean != 0)
+
+
+def varianceOfLaplacian(stack):
+    """Variance of the 4-neighbour Laplacian"""
+    laplacian = (stack[:, 1:-1, :-2] + stack[:, 1:-1, 2:] +
+                 stack[:, :-2, 1:-1] + stack[:, 2:, 1:-1] -
+                 4 * stack[:, 1:-1, 1:-1])
+    return laplacian.var(axis=(1, 2))
+
+
+def brenner(stack):
+    """Mean squared difference between pixels two columns apart"""
+    diff = stack[:, :, 2:] - stack[:, :, :-2]
+    return (diff * diff).mean(axis=(1, 2))
+
+
+def tenengrad(stack):
+    """Mean squared Sobel gradient magnitude"""
+    smooth_y = stack[:, :-2, :] + 2 * stack[:, 1:-1, :] + stack[:, 2:, :]
+    gx = smooth_y[:, :, 2:] - smooth_y[:, :, :-2]
+    smooth_x = stack[:, :, :-2] + 2 * stack[:, :, 1:-1] + stack[:, :, 2:]
+    gy = smooth_x[:, 2:, :] - smooth_x[:, :-2, :]
+    return (gx * gx + gy * gy).mean(axis=(1, 2))
+
+
+FOCUS_METRICS = {
+    'Standard_Deviation': standardDeviation,
+    'Normalised_Variance': normalisedVariance,
+    'Variance_of_Laplacian': varianceOfLaplacian,
+    'Brenner': brenner,
+    'Tenengrad': tenengrad,
+}
+
+
+def getMetrics(script_params):
+    """Names of the focus metrics chosen by the Metric parameter"""
+    if script_params["Metric"] == 'All':
+        return list(FOCUS_METRICS)
+    return [script_params["Metric"]]
+
+
+class FocusCurve(object):
+    """
+    Focus values of the Z planes of one channel and timepoint. Planes are
+    read only when first asked for, and every metric is computed from each
+    read so searches for several metrics share their downloads.
+    """
+
+    def __init__(self, raw_pixel_store, pixels, the_c, the_t, metrics,
+                 tiles=None):
+        self.raw_pixel_store = raw_pixel_store
+        self.pixels = pixels
+        self.the_c = the_c
+        self.the_t = the_t
+        self.metrics = metrics
+        self.tiles = tiles
+        self.size_z = pixels.getSizeZ().getValue()
+        self.itemsize = get_dtype(pixels).itemsize
+        self.values = {}
+        self.bytes = 0
+        self.requests = 0
+
+    def __call__(self, metric, zs):
+        """Values of metric for the planes zs, reading any not seen yet"""
+        missing = sorted(set(zs) - set(self.values))
+        if self.tiles:
+            # One value per plane, averaged over its tiles
+            for first, stack in get_tiles(self.raw_pixel_store, self.pixels,
+                                          self.the_c, self.the_t, missing,
+                                          self.tiles):
+                self.requests += len(self.tiles)
+                self.bytes += stack.size * self.itemsize
+                for i, plane_tiles in enumerate(stack):
+                    self.values[first + i] = dict(
+                        (name, FOCUS_METRICS[name](plane_tiles).mean())
+                        for name in self.metrics)
+        else:
+            for first, stack in get_planes(self.raw_pixel_store, self.pixels,
+                                           self.the_c, self.the_t, missing):
+                self.requests += 1
+                self.bytes += stack.size * self.itemsize
+                results = [FOCUS_METRICS[name](stack)
+                           for name in self.metrics]
+                for i in range(len(stack)):
+                    self.values[first + i] = dict(
+                        (name, result[i])
+                        for name, result in zip(self.metrics, results))
+        return [self.values[z][metric] for z in zs]
+
+
+def fullPlaneFocus(raw_pixel_store, pixels, the_c, the_t, metrics):
+    """
+    Best plane for each metric read the original way, one full plane at a
+    time with get_plane, and the number of bytes read and requests made.
+    Used as the reference when benchmarking.
+    """
+    values = dict((name, []) for name in metrics)
+    nbytes = 0
+    for z in range(pixels.getSizeZ().getValue()):
+        plane = get_plane(raw_pixel_store, pixels, z, the_c, the_t)
+        nbytes += plane.nbytes
+        stack = plane[np.newaxis].astype(np.float64)
+        for name in metrics:
+            values[name].append(FOCUS_METRICS[name](stack)[0])
+    best = dict((name, int(np.argmax(values[name]))) for name in metrics)
+    return best, nbytes, len(values[metrics[0]])
+
+
+# Planes sampled across the stack before refining a coarse-to-fine search
+COARSE_SAMPLES = 8
+
+
+def isUnimodal(values):
+    """True if values never rise again once they have started to fall"""
+    falling = False
+    for diff in np.diff(values):
+        if diff < 0:
+            falling = True
+        elif diff > 0 and falling:
+            return False
+    return True
+
+
+def exhaustiveSearch(curve, metric):
+    """Index of the best plane, reading every plane"""
+    zs = list(range(curve.size_z))
+    return zs[int(np.argmax(curve(metric, zs)))]
+
+
+def coarseToFineSearch(curve, metric):
+    """
+    Index of the best plane of a unimodal focus curve, sampling the stack
+    at a coarse stride then halving the stride around the best plane found
+    so far. Falls back to the exhaustive search if the coarse samples are
+    not unimodal.
+    """
+    stride = max(1, curve.size_z // COARSE_SAMPLES)
+    zs = list(range(0, curve.size_z, stride))
+    values = curve(metric, zs)
+    if not isUnimodal(values):
+        log("%s focus curve is not unimodal, reading every plane" % metric)
+        return exhaustiveSearch(curve, metric)
+    best = zs[int(np.argmax(values))]
+    while stride > 1:
+        stride = (stride + 1) // 2
+        zs = [z for z in (best - stride, best, best + stride)
+              if 0 <= z < curve.size_z]
+        best = zs[int(np.argmax(curve(metric, zs)))]
+    return best
+
+
+SEARCHES = {
+    'Exhaustive': exhaustiveSearch,
+    'Coarse_to_Fine': coarseToFineSearch,
+}
+
+
+def focusPlanes(image, script_params):
+    """
+    (C, T) searched in an image, every channel and timepoint when
+    Focus_Map is set and Channel at T=0 otherwise
+    """
+    if script_params.get("Focus_Map", False):
+        return [(c, t) for t in range(image.getSizeT())
+                for c in range(image.getSizeC())]
+    return [(script_params["Channel"], 0)]
+
+
+def findFocus(image, metrics, script_params, store_pool):
+    """
+    Best plane of an image for each metric and each of its focusPlanes.
+    Returns rows (image ID, C, T, best Z counted from 1, metric, value)
+    and the reading and benchmark counts.
+    """
+    pixels = image._obj.getPrimaryPixels()
+    planes = focusPlanes(image, script_params)
+    tiles = None
+    if script_params["Sampling"]:
+        tiles = sampleTiles(pixels, script_params["Sampling"])
+    search = SEARCHES[script_params["Search"]]
+    result = {'rows': [], 'planes': 0, 'bytes': 0, 'requests': 0,
+              'agree': 0, 'total': 0, 'full_bytes': 0, 'full_requests': 0}
+    with store_pool.acquire() as raw_pixel_store:
+        raw_pixel_store.setPixelsId(pixels.getId().getValue(), True)
+        for the_c, the_t in planes:
+            curve = FocusCurve(raw_pixel_store, pixels, the_c, the_t,
+                               metrics, tiles)
+            best = {}
+            for name in metrics:
+                best[name] = search(curve, name)
+                result['rows'].append(
+                    (image.getId(), the_c, the_t, best[name] + 1, name,
+                     float(curve.values[best[name]][name])))
+            result['planes'] += len(curve.values)
+            result['bytes'] += curve.bytes
+            result['requests'] += curve.requests
+            if script_params.get("Benchmark", False):
+                full, nbytes, requests = fullPlaneFocus(
+                    raw_pixel_store, pixels, the_c, the_t, metrics)
+                for name in metrics:
+                    log("Benchmark image %s C=%d T=%d %s: plane %d, full "
+                        "planes give %d" % (image.getId(), the_c, the_t,
+                                            name, best[name] + 1,
+                                            full[name] + 1))
+                    result['agree'] += best[name] == full[name]
+                    result['total'] += 1
+                result['full_bytes'] += nbytes
+                result['full_requests'] += requests
+    log("Image %s: read %d of %d planes, %.1f MB in %d requests"
+        % (image.getId(), result['planes'], image.getSizeZ() * len(planes),
+           result['bytes'] / 1e6, result['requests']))
+    return result
+
+
+class StorePool(object):
+    """
+    Fixed set of raw pixels stores, opened once, shared by the workers
+    and closed together at the end
+    """
+
+    def __init__(self, conn, size):
+        self.stores = [conn.c.sf.createRawPixelsStore() for i in range(size)]
+        self.free = queue.Queue()
+        for store in self.stores:
+            self.free.put(store)
+
+    @contextmanager
+    def acquire(self):
+        store = self.free.get()
+        try:
+            yield store
+        finally:
+            self.free.put(store)
+
+    def close(self):
+        for store in self.stores:
+            try:
+                store.close()
+            except Exception as e:
+                log("Could not close raw pixels store: %s" % e)
+
+
+CACHE_NS = "camdu.focus_cache"
+
+
+def getFingerprint(image, script_params):
+    """
+    Identify focus results by the pixels and their last update, and by
+    the parameters that change the plane found
     """
-    Caluclate standard deviation of plane
+    pixels = image._obj.getPrimaryPixels()
+    key = "%s:%s:%s:%s" % (
+        pixels.getId().getValue(),
+        pixels.getDetails().getUpdateEvent().getId().getValue(),
+        script_params["Search"], script_params["Sampling"])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def cacheKey(the_c, the_t, metric):
+    return "C%d/T%d/%s" % (the_c, the_t, metric)
+
+
+def findCachedFocus(conn, images):
+    """
+    Cache annotation of each image, with its fingerprint and its results
+    by cacheKey as (Z, value), looked up in one query per chunk
+    """
+    query_service = conn.getQueryService()
+    cached = {}
+    for chunk in chunks([image.getId() for image in images]):
+        params = ParametersI()
+        params.addIds(chunk)
+        params.add("ns", rstring(CACHE_NS))
+        for link in query_service.findAllByQuery(
+                "select l from ImageAnnotationLink l "
+                "join fetch l.child a left outer join fetch a.mapValue "
+                "where a.ns = :ns and l.parent.id in (:ids)",
+                params, conn.SERVICE_OPTS):
+            ann = link.getChild()
+            entries = dict((nv.name, nv.value) for nv in ann.getMapValue())
+            results = {}
+            for name, value in entries.items():
+                if '/' in name:
+                    z, v = value.split(',')
+                    results[name] = (int(z), float(v))
+            cached[link.getParent().getId().getValue()] = {
+                'annotation': ann,
+                'fingerprint': entries.get('fingerprint'),
+                'results': results}
+    return cached
+
+
+def cachedFocus(image, metrics, script_params, cache):
+    """
+    Result of findFocus answered from the cache, or None if the pixels
+    changed or any (C, T, metric) is missing
+    """
+    if cache is None or (
+            cache['fingerprint'] != getFingerprint(image, script_params)):
+        return None
+    rows = []
+    for the_c, the_t in focusPlanes(image, script_params):
+        for name in metrics:
+            key = cacheKey(the_c, the_t, name)
+            if key not in cache['results']:
+                return None
+            z, value = cache['results'][key]
+            rows.append((image.getId(), the_c, the_t, z, name, value))
+    return {'rows': rows, 'planes': 0, 'bytes': 0, 'requests': 0,
+            'agree': 0, 'total': 0, 'full_bytes': 0, 'full_requests': 0}
+
+
+def cacheObject(image, script_params, rows, cache):
+    """
+    Unsaved annotation or link recording the rows of an image. Results
+    still valid in its existing cache annotation are kept, stale ones are
+    replaced.
+    """
+    fingerprint = getFingerprint(image, script_params)
+    results = {}
+    if cache is not None and cache['fingerprint'] == fingerprint:
+        results.update(cache['results'])
+    for image_id, the_c, the_t, z, name, value in rows:
+        results[cacheKey(the_c, the_t, name)] = (z, value)
+    values = [omero.model.NamedValue('fingerprint', fingerprint),
+              omero.model.NamedValue('search', script_params["Search"]),
+              omero.model.NamedValue('sampling',
+                                     str(script_params["Sampling"]))]
+    for key in sorted(results):
+        values.append(omero.model.NamedValue(key, "%d,%r" % results[key]))
+    if cache is not None:
+        cache['annotation'].setMapValue(values)
+        return cache['annotation']
+    ann = omero.model.MapAnnotationI()
+    ann.setNs(rstring(CACHE_NS))
+    ann.setMapValue(values)
+    link = omero.model.ImageAnnotationLinkI()
+    link.setParent(omero.model.ImageI(image.getId(), False))
+    link.setChild(ann)
+    return link
+
+
+def saveCache(conn, objects):
+    """Save cache annotations and links, one call per chunk"""
+    update_service = conn.getUpdateService()
+    for chunk in chunks(objects):
+        update_service.saveArray(chunk, conn.SERVICE_OPTS)
+
+
+FOCUS_MAP_NS = "camdu.focus_map"
+FOCUS_MAP_COLUMNS = ['Image ID', 'C', 'T', 'Z', 'Metric', 'Value']
+
+
+def readFocusMaps(annotations):
+    """
+    Rows of the focus map CSV files, by image ID, later files replacing
+    the rows of earlier ones
     """
-    max_std = 0
-    for z in range(sizeZ):
-        plane = get_plane(raw_pixel_store, pixels, z, channel, 0)
-        std = np.std(plane)
-        if std > max_std:
-            max_std = std
-            slice = z
-    return slice + 1
+    rows = {}
+    for ann in sorted(annotations, key=lambda ann: ann.getId()):
+        text = b''.join(ann.getFileInChunks()).decode('utf-8')
+        found = {}
+        for row in list(csv.reader(io.StringIO(text)))[1:]:
+            if row:
+                found.setdefault(int(row[0]), []).append(row)
+        rows.update(found)
+    return rows
+
+
+def saveFocusMap(conn, dataset, rows):
+    """
+    Upload rows as a CSV file annotation on the dataset. The focus map
+    saved there by earlier runs is replaced, keeping its rows for images
+    not in rows.
+    """
+    filename = "Focus_map_%s.csv" % dataset.getId()
+    old = list(dataset.listAnnotations(ns=FOCUS_MAP_NS))
+    kept = readFocusMaps(old)
+    for image_id in set(row[0] for row in rows):
+        kept.pop(image_id, None)
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(FOCUS_MAP_COLUMNS)
+        for image_rows in kept.values():
+            writer.writerows(image_rows)
+        writer.writerows(rows)
+    # create the original file and file annotation (uploads the file)
+    file_ann = conn.createFileAnnfromLocalFile(
+        filename, mimetype="text/csv", ns=FOCUS_MAP_NS, desc=None)
+    dataset.linkAnnotation(file_ann)
+    os.remove(filename)
+    # Removed only once the new map is linked, so a failed upload keeps it
+    if old:
+        conn.deleteObjects("Annotation", [ann.getId() for ann in old],
+                           wait=True)
+    log("Saved %d focus results to dataset %s, kept %d image(s) from "
+        "earlier runs" % (len(rows), dataset.getId(), len(kept)))
+
 
 def runScript():
     dataTypes = [rstring('Dataset'), rstring('Image')]
+    metrics = [rstring(name) for name in FOCUS_METRICS] + [rstring('All')]
+    searches = [rstring(name) for name in SEARCHES]
     client = scripts.client(
         "Find_in_focus_plane.py", """Identify the most in focus plane 
         (from the first time step). Outputs Z plane number to be used with
-        Batch Image Export script""",
+        Batch Image Export script, or with Focus_Map a table of the plane
+        of every channel and timepoint""",
         scripts.String(
             "Data_Type", optional=False, grouping="01", values=dataTypes,
             default="Image"),
@@ -73,6 +639,39 @@ def runScript():
         scripts.Int(
             "Channel", optional=False, grouping="03",
             description="""Channel to analyse""", min=0, default=0),
+        scripts.String(
+            "Metric", optional=False, grouping="04",
+            description="""Focus measure to maximise. All computes every
+            measure from the same download of the stack""",
+            values=metrics, default="Standard_Deviation"),
+        scripts.String(
+            "Search", optional=False, grouping="05",
+            description="""Exhaustive reads every plane. Coarse_to_Fine
+            reads about log2(Z) planes when the focus curve has a single
+            peak, and every plane otherwise""",
+            values=searches, default="Exhaustive"),
+        scripts.Int(
+            "Sampling", optional=False, grouping="06",
+            description="""Number of tiles spread over the field to compute
+            the metric on, instead of the full plane. 0 uses the full
+            plane""", min=0, default=0),
+        scripts.Bool(
+            "Benchmark", grouping="07", default=False,
+            description="""Also find the plane from every full plane and
+            log how often the results agree and the bytes each read"""),
+        scripts.Bool(
+            "Focus_Map", grouping="08", default=False,
+            description="""Find the plane for every channel and timepoint
+            and save the results as a CSV table on the dataset of each
+            image, replacing the rows of the images processed, instead of
+            printing them"""),
+        scripts.Int(
+            "Max_Workers", grouping="09", min=1, default=4,
+            description="Number of images to process at the same time"),
+        scripts.Bool(
+            "Force_Recompute", grouping="10", default=False,
+            description="""Read the planes again even when the results
+            are cached on the image and its pixels have not changed"""),
         version="0.0",
         authors=["Laura Cooper", "CAMDU"],
         institutions=["University of Warwick"],
@@ -83,19 +682,88 @@ def runScript():
         conn = BlitzGateway(client_obj=client)
         script_params = client.getInputs(unwrap=True)
         images = getImages(conn, script_params)
-        # Create new dataset if Dataset_Name is defined
-        for image in images:
-            sizeZ=image.getSizeZ()
-            # Skip image if Z dimension is 1 or if given Z range is less than 1
-            if (sizeZ > 1):
-                # Get plane as numpy array
-                raw_pixel_store = conn.c.sf.createRawPixelsStore()
-                query_service = conn.getQueryService()
-                query_string = "select p from Pixels p join fetch p.image i "\
-                    "join fetch p.pixelsType pt where i.id='%d'" % image.getId()
-                pixels = query_service.findByQuery(query_string, None)
-                z = stdCalculator(script_params["Channel"], raw_pixel_store, pixels, sizeZ)
-                print("Image ID: ", image.getId(), " In focus plane: ", z)
+        metrics = getMetrics(script_params)
+        # Skip image if Z dimension is 1
+        images = [image for image in images if image.getSizeZ() > 1]
+        focus_map = script_params.get("Focus_Map", False)
+        # Maps are saved on the selected datasets, not other parents
+        selected = None
+        if script_params["Data_Type"] == 'Dataset':
+            selected = set(script_params["IDs"])
+        # Looked up even when forced, so existing annotations are updated
+        cache = findCachedFocus(conn, images)
+        cached = {}
+        if not script_params.get("Force_Recompute", False):
+            for image in images:
+                result = cachedFocus(image, metrics, script_params,
+                                     cache.get(image.getId()))
+                if result is not None:
+                    cached[image.getId()] = result
+            if cached:
+                log("Using cached results for %d image(s), use "
+                    "Force_Recompute to read them again" % len(cached))
+        store_pool = StorePool(conn, script_params["Max_Workers"])
+        # Focus map rows for each dataset
+        tables = {}
+        datasets = {}
+        # Cache annotations to save
+        updates = []
+        planes = read_bytes = requests = agree = total = 0
+        full_bytes = full_requests = 0
+        try:
+            with ThreadPoolExecutor(script_params["Max_Workers"]) as pool:
+                futures = dict((image.getId(),
+                                pool.submit(findFocus, image, metrics,
+                                            script_params, store_pool))
+                               for image in images
+                               if image.getId() not in cached)
+                for image in images:
+                    if image.getId() in cached:
+                        result = cached[image.getId()]
+                    else:
+                        result = futures[image.getId()].result()
+                        updates.append(cacheObject(
+                            image, script_params, result['rows'],
+                            cache.get(image.getId())))
+                    planes += result['planes']
+                    read_bytes += result['bytes']
+                    requests += result['requests']
+                    agree += result['agree']
+                    total += result['total']
+                    full_bytes += result['full_bytes']
+                    full_requests += result['full_requests']
+                    if focus_map:
+                        image_datasets = getDatasets(conn, image, selected)
+                        if not image_datasets:
+                            log("Image %s is not in a dataset, its focus map "
+                                "is not saved" % image.getId())
+                        for dataset in image_datasets:
+                            datasets[dataset.getId()] = dataset
+                            tables.setdefault(dataset.getId(), []).extend(
+                                result['rows'])
+                        continue
+                    for image_id, c, t, z, name, value in result['rows']:
+                        if len(metrics) == 1:
+                            print("Image ID: ", image_id,
+                                  " In focus plane: ", z)
+                        else:
+                            print("Image ID: ", image_id,
+                                  " In focus plane: ", z, " Metric: ", name)
+        finally:
+            store_pool.close()
+            # Results found so far are cached even if a later image failed
+            saveCache(conn, updates)
+        for dataset_id, rows in tables.items():
+            saveFocusMap(conn, datasets[dataset_id], rows)
+        log("Read %d planes, %.1f MB in %d requests"
+            % (planes, read_bytes / 1e6, requests))
+        if total:
+            log("Benchmark: %d of %d results match the full planes, "
+                "%.1f MB in %d requests instead of %.1f MB in %d requests "
+                "(%.1f%% of the bytes)"
+                % (agree, total, read_bytes / 1e6, requests,
+                   full_bytes / 1e6, full_requests,
+                   100.0 * read_bytes / max(full_bytes, 1)))
 
     finally:
         # Cleanup
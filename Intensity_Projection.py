@@ -1,69 +1,164 @@
 # import the omero package and the omero.scripts package.
 import omero
 import omero.scripts as scripts
-from omero.gateway import BlitzGateway, DatasetWrapper
-from omero.rtypes import rlong, rstring, robject
-import omero.util.script_utils as script_utils
+from omero.gateway import (BlitzGateway, ChannelWrapper, DatasetWrapper,
+                           ImageWrapper)
+from omero.rtypes import rdouble, rlist, rlong, rstring, robject
+from omero.sys import ParametersI
 import numpy as np
+import hashlib
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 '''
 Slow, low memory usage
 '''
 
+# Maximum number of bytes fetched from the server in one request
+DEFAULT_CHUNK_SIZE = 32 * 1024 * 1024
+# Number of chunks downloaded ahead of the one being projected
+DEFAULT_READ_AHEAD = 2
+# Number of projections whose metadata is written back together
+METADATA_BATCH_SIZE = 20
+# Namespace of the map annotations identifying how a projection was made
+FINGERPRINT_NS = "camdu.intensity_projection"
+
 
 def log(data):
     """Handle logging or printing in one place."""
     print(data)
 
 
-def copyMetadata(conn, newImage, image):
+def copyMetadata(conn, outputs, script_params):
     """
-    Copy important metadata
-    Reload to prevent update conflicts
+    Copy important metadata from each source image to its projections.
+    outputs are the dicts returned by projectImage, with the source image
+    added. The new pixels are loaded with their channels, updated and saved
+    together with the channel ranges and fingerprint annotations, then the
+    rendering settings of all new images are reset in one call.
     """
-    newImage = conn.getObject("Image", newImage.getId())
-    new_pixs = newImage.getPrimaryPixels()._obj
-    old_pixs = image.getPrimaryPixels()._obj
-    new_pixs.setPhysicalSizeX(old_pixs.getPhysicalSizeX())
-    new_pixs.setPhysicalSizeY(old_pixs.getPhysicalSizeY())
-    new_pixs.setPhysicalSizeZ(old_pixs.getPhysicalSizeZ())
-    conn.getUpdateService().saveObject(new_pixs)
-    for old_channels, new_channels in zip(image.getChannels(),
-                                          newImage.getChannels()):
-        new_LogicChan = new_channels._obj.getLogicalChannel()
-        new_LogicChan.setName(rstring(old_channels.getLabel()))
-        new_LogicChan.setEmissionWave(old_channels.getEmissionWave(units=True))
-        new_LogicChan.setExcitationWave(
-            old_channels.getExcitationWave(units=True))
-        conn.getUpdateService().saveObject(new_LogicChan)
+    query_service = conn.getQueryService()
+    update_service = conn.getUpdateService()
+    query = "select p from Pixels p join fetch p.channels c "\
+        "join fetch c.logicalChannel where p.image.id in (:ids)"
+    for batch in chunks(outputs):
+        channels = {}
+        source_ids = list(set(output['source'].getId() for output in batch))
+        params = ParametersI()
+        params.addIds(source_ids)
+        for pixels in query_service.findAllByQuery(query, params,
+                                                   conn.SERVICE_OPTS):
+            channels[pixels.getImage().getId().getValue()] = [
+                ChannelWrapper(conn, channel, idx=i)
+                for i, channel in enumerate(pixels.copyChannels())]
+        # Reload to prevent update conflicts
+        new_ids = [output['image'].getId() for output in batch]
+        params = ParametersI()
+        params.addIds(new_ids)
+        new_pixels = dict(
+            (pixels.getImage().getId().getValue(), pixels)
+            for pixels in query_service.findAllByQuery(query, params,
+                                                       conn.SERVICE_OPTS))
+        links = []
+        for output in batch:
+            image, scale = output['source'], output['scale']
+            links.append(fingerprintLink(output['image'], image,
+                                         script_params, output['fingerprint'],
+                                         output['level']))
+            new_pixs = new_pixels[output['image'].getId()]
+            old_pixs = image.getPrimaryPixels()._obj
+            new_pixs.setPhysicalSizeX(
+                scaleLength(old_pixs.getPhysicalSizeX(), scale[0]))
+            new_pixs.setPhysicalSizeY(
+                scaleLength(old_pixs.getPhysicalSizeY(), scale[1]))
+            new_pixs.setPhysicalSizeZ(old_pixs.getPhysicalSizeZ())
+            for c, (old_channels, new_channels) in enumerate(zip(
+                    channels[image.getId()], new_pixs.copyChannels())):
+                # Ranges of the written pixels, for the rendering settings
+                low, high = output['minmax'][c]
+                stats = omero.model.StatsInfoI()
+                stats.setGlobalMin(rdouble(float(low)))
+                stats.setGlobalMax(rdouble(float(high)))
+                new_channels.setStatsInfo(stats)
+                new_LogicChan = new_channels.getLogicalChannel()
+                new_LogicChan.setName(rstring(old_channels.getLabel()))
+                new_LogicChan.setEmissionWave(
+                    old_channels.getEmissionWave(units=True))
+                new_LogicChan.setExcitationWave(
+                    old_channels.getExcitationWave(units=True))
+        # Channels and logical channels are saved with their pixels
+        update_service.saveArray(list(new_pixels.values()) + links,
+                                 conn.SERVICE_OPTS)
+        conn.getRenderingSettingsService().resetDefaultsInSet(
+            "Image", new_ids, conn.SERVICE_OPTS)
+
+
+# Number of IDs passed to one HQL query
+QUERY_CHUNK_SIZE = 500
 
-    if newImage._prepareRenderingEngine():
-        newImage._re.resetDefaultSettings(True)
+
+def chunks(ids, size=QUERY_CHUNK_SIZE):
+    """Split a list of IDs into lists of at most size IDs"""
+    for i in range(0, len(ids), size):
+        yield ids[i:i + size]
 
 
 def getImages(conn, script_params):
     """
-    Get the images
+    Get the images, with their pixels, pixels type, parent datasets and
+    owners loaded in a few queries chunked by ID, so later lookups don't
+    go back to the server
     """
-    message = ""
-    objects, log_message = script_utils.get_objects(conn, script_params)
-    message += log_message
-    if not objects:
-        return None, message
-
-    data_type = script_params["Data_Type"]
-
-    if data_type == 'Dataset':
-        images = []
-        for ds in objects:
-            images.extend(list(ds.listChildren()))
-        if not images:
-            message += "No image found in dataset(s)"
-            return None, message
+    query_service = conn.getQueryService()
+    ids = script_params["IDs"]
+    if script_params["Data_Type"] == 'Dataset':
+        image_ids = []
+        for chunk in chunks(ids):
+            params = ParametersI()
+            params.addIds(chunk)
+            rows = query_service.projection(
+                "select l.child.id from DatasetImageLink l "
+                "where l.parent.id in (:ids) order by l.parent.id, l.child.id",
+                params, conn.SERVICE_OPTS)
+            image_ids.extend(row[0].getValue() for row in rows)
+        if not image_ids:
+            log("No image found in dataset(s)")
     else:
-        images = objects
+        image_ids = ids
+    loaded = {}
+    for chunk in chunks(list(set(image_ids))):
+        params = ParametersI()
+        params.addIds(chunk)
+        for obj in query_service.findAllByQuery(
+                "select distinct i from Image i "
+                "join fetch i.details.owner "
+                "join fetch i.pixels p join fetch p.pixelsType "
+                "left outer join fetch i.datasetLinks l "
+                "left outer join fetch l.parent d "
+                "left outer join fetch d.details.owner "
+                "where i.id in (:ids)", params, conn.SERVICE_OPTS):
+            loaded[obj.getId().getValue()] = obj
+    missing = len(set(image_ids) - set(loaded))
+    if missing:
+        log("%d image(s) not found" % missing)
+    # Keep the order of selection, once per image
+    images = []
+    for image_id in image_ids:
+        if image_id in loaded:
+            images.append(ImageWrapper(conn, loaded.pop(image_id)))
     return images
 
 
+def getDataset(conn, image):
+    """First parent dataset of an image loaded by getImages, or None"""
+    links = image._obj.copyDatasetLinks()
+    if not links:
+        return None
+    return DatasetWrapper(conn, links[0].getParent())
+
+
 def getRoiShape(s):
     shape = {}
     shape['x'] = int(np.floor(s.getX().getValue()))
@@ -73,37 +168,847 @@ def getRoiShape(s):
     return shape
 
 
-def get_plane(raw_pixel_store, pixels, the_z, the_c, the_t):
-    # get the plane
-    pixels_id = pixels.getId().getValue()
-    raw_pixel_store.setPixelsId(pixels_id, True)
-    return script_utils.download_plane(raw_pixel_store, pixels, the_z, the_c, the_t)
+def clipShape(shape, size_x, size_y):
+    """
+    Clip a shape to the image so it can be read from the server,
+    returns None if nothing is left
+    """
+    x0, y0 = max(shape['x'], 0), max(shape['y'], 0)
+    x1 = min(shape['x'] + shape['w'], size_x)
+    y1 = min(shape['y'] + shape['h'], size_y)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return {'x': x0, 'y': y0, 'w': x1 - x0, 'h': y1 - y0}
+
+
+def scaleShape(shape, scale_x, scale_y, size_x, size_y):
+    """Shape in the coordinates of a lower resolution level"""
+    x0 = int(np.floor(shape['x'] * scale_x))
+    y0 = int(np.floor(shape['y'] * scale_y))
+    x1 = int(np.ceil((shape['x'] + shape['w']) * scale_x))
+    y1 = int(np.ceil((shape['y'] + shape['h']) * scale_y))
+    return clipShape({'x': x0, 'y': y0, 'w': x1 - x0, 'h': y1 - y0},
+                     size_x, size_y)
+
+
+def scaleLength(length, scale):
+    """Physical pixel size once scale times as many pixels cover it"""
+    if length is None or scale == 1:
+        return length
+    return omero.model.LengthI(length.getValue() / scale, length.getUnit())
+
+
+def boundingShape(shapes):
+    """Smallest rectangle containing all the shapes"""
+    x0 = min(s['x'] for s in shapes)
+    y0 = min(s['y'] for s in shapes)
+    x1 = max(s['x'] + s['w'] for s in shapes)
+    y1 = max(s['y'] + s['h'] for s in shapes)
+    return {'x': x0, 'y': y0, 'w': x1 - x0, 'h': y1 - y0}
+
+
+# Largest ratio of a shared read box's area to the area of its shapes
+GROUP_OVERHEAD = 2.0
+
+
+def groupShapes(shapes, overhead=GROUP_OVERHEAD):
+    """
+    Split shapes into groups read through one bounding box each, as
+    (box, indices of the shapes). A shape joins a group only while the
+    box stays within overhead times the area of its shapes, so nearby
+    shapes share a read and scattered ones are read on their own.
+    """
+    def area(s):
+        return s['w'] * s['h']
+
+    groups = []
+    order = sorted(range(len(shapes)),
+                   key=lambda i: (shapes[i]['y'], shapes[i]['x']))
+    for i in order:
+        for group in groups:
+            members = group[1] + [i]
+            box = boundingShape([shapes[j] for j in members])
+            if area(box) <= overhead * sum(area(shapes[j])
+                                           for j in members):
+                group[0], group[1] = box, members
+                break
+        else:
+            groups.append([dict(shapes[i]), [i]])
+    return [(box, indices) for box, indices in groups]
+
+
+PIXEL_TYPES = {'int8': np.int8, 'uint8': np.uint8,
+               'int16': np.int16, 'uint16': np.uint16,
+               'int32': np.int32, 'uint32': np.uint32,
+               'float': np.float32, 'double': np.float64}
+PIXEL_TYPE_NAMES = dict((v, k) for k, v in PIXEL_TYPES.items())
+
+
+def get_dtype(pixels):
+    """Big-endian numpy dtype of the pixels, as sent by the server"""
+    pixel_type = pixels.getPixelsType().getValue().getValue()
+    return np.dtype(PIXEL_TYPES[pixel_type]).newbyteorder('>')
+
+
+def readLevel(raw_pixel_store, pixels, level):
+    """
+    Resolution level read when level is asked for: the smallest one if
+    there are fewer levels, and full size for pixels without a pyramid.
+    Store must already be bound to the pixels.
+    """
+    if not level:
+        return 0
+    levels = raw_pixel_store.getResolutionLevels()
+    if levels < 2:
+        log("Pixels %s have no resolution levels, reading full size"
+            % pixels.getId().getValue())
+        return 0
+    return min(level, levels - 1)
+
+
+def getLevels(conn, images, level):
+    """
+    Resolution level read from each image when level is asked for, found
+    up front so outputs are named and fingerprinted after what is read
+    """
+    if not level:
+        return dict((image.getId(), 0) for image in images)
+    levels = {}
+    raw_pixel_store = conn.c.sf.createRawPixelsStore()
+    try:
+        for image in images:
+            pixels = image._obj.getPrimaryPixels()
+            raw_pixel_store.setPixelsId(pixels.getId().getValue(), True)
+            levels[image.getId()] = readLevel(raw_pixel_store, pixels, level)
+    finally:
+        raw_pixel_store.close()
+    return levels
+
+
+def bind_store(raw_pixel_store, pixels, level=0):
+    """
+    Point the raw pixels store at the pixels, once per image. For pyramidal
+    pixels level picks a lower resolution, 0 being full size and each level
+    above it the next smaller one. Returns the X and Y size that is read.
+    """
+    raw_pixel_store.setPixelsId(pixels.getId().getValue(), True)
+    size_x = pixels.getSizeX().getValue()
+    size_y = pixels.getSizeY().getValue()
+    level = readLevel(raw_pixel_store, pixels, level)
+    if level:
+        levels = raw_pixel_store.getResolutionLevels()
+        # The store counts its levels up from the smallest
+        raw_pixel_store.setResolutionLevel(levels - 1 - level)
+        description = raw_pixel_store.getResolutionDescriptions()[level]
+        size_x, size_y = description.sizeX, description.sizeY
+    return size_x, size_y
+
+
+def get_stack(raw_pixel_store, pixels, Z, the_c, T, shape, chunk_size,
+              use_tiles=False):
+    """
+    Yield the planes Z[0] to Z[1]-1 of one channel at timepoints T[0] to
+    T[1]-1 as (n, h, w) arrays covering only the region in shape, fetching
+    as many planes per request as fit in chunk_size bytes. Runs along Z
+    for each timepoint, or along T when there is a single Z plane. Store
+    must already be bound with bind_store. Pyramidal pixels cannot serve
+    hypercubes, so use_tiles reads them one tile per plane instead.
+    """
+    dtype = get_dtype(pixels)
+    step = max(1, chunk_size // (shape['w'] * shape['h'] * dtype.itemsize))
+    if Z[1] - Z[0] > 1:
+        runs = [(Z, [t, t + 1]) for t in range(T[0], T[1])]
+    else:
+        runs = [(Z, T)]
+    for Zr, Tr in runs:
+        along_z = Zr[1] - Zr[0] > 1
+        start, stop = Zr if along_z else Tr
+        for first in range(start, stop, step):
+            n = min(step, stop - first)
+            z, t = (first, Tr[0]) if along_z else (Zr[0], first)
+            if use_tiles:
+                raw = b''.join(raw_pixel_store.getTile(
+                    z + i if along_z else z, the_c, t if along_z else t + i,
+                    shape['x'], shape['y'], shape['w'], shape['h'])
+                    for i in range(n))
+            else:
+                raw = raw_pixel_store.getHypercube(
+                    [shape['x'], shape['y'], z, the_c, t],
+                    [shape['w'], shape['h'], n if along_z else 1, 1,
+                     1 if along_z else n], [1, 1, 1, 1, 1])
+            stack = np.frombuffer(raw, dtype=dtype).reshape(
+                n, shape['h'], shape['w'])
+            yield stack.astype(dtype.newbyteorder('='))
+
+
+def outputPlanes(axis, Z, C, T):
+    """
+    List (z, c, t, Z range, T range) of every plane of the projection
+    along axis ('Z', 'T' or 'ZT'), with z and t counted in the output
+    image. Every source plane belongs to exactly one output plane, so is
+    read once.
+    """
+    if 'Z' in axis:
+        zs = [(0, Z)]
+    else:
+        zs = [(z - Z[0], [z, z + 1]) for z in range(Z[0], Z[1])]
+    if 'T' in axis:
+        ts = [(0, T)]
+    else:
+        ts = [(t - T[0], [t, t + 1]) for t in range(T[0], T[1])]
+    return [(z, c, t, Zr, Tr) for z, Zr in zs for c in range(C)
+            for t, Tr in ts]
+
+
+def readJobs(raw_pixel_store, pixels, jobs, chunk_size, use_tiles=False):
+    """
+    Yield (job, stack) for every chunk of every (output plane, shape) job
+    in turn, followed by (job, None) once the job has been read completely
+    """
+    for job in jobs:
+        (z, the_c, t, Zr, Tr), shape = job
+        for stack in get_stack(raw_pixel_store, pixels, Zr, the_c, Tr,
+                               shape, chunk_size, use_tiles):
+            yield job, stack
+        yield job, None
+
+
+def prefetch(iterable, depth):
+    """
+    Consume iterable in a background thread, keeping up to depth items
+    read ahead in a bounded queue, so the next chunks download while the
+    current one is reduced. Exceptions are raised again in the caller.
+    """
+    if depth < 1:
+        for item in iterable:
+            yield item
+        return
+    buffer = queue.Queue(depth)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up if the caller went away instead of blocking forever
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+        except Exception as e:
+            put((False, e))
+            return
+        put((False, None))
+
+    reader = threading.Thread(target=worker)
+    reader.daemon = True
+    reader.start()
+    try:
+        while True:
+            ok, item = buffer.get()
+            if not ok:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        reader.join()
+
+
+class Reducer(object):
+    """
+    Reduce a stream of (n, y, x) chunks into one output plane, in place
+    in an accumulator allocated up front, so memory does not depend on
+    the depth of the stack.
+    """
+    # Pixel type of the result, None keeps the source type
+    out_dtype = None
+
+    def __init__(self, shape, dtype, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.chunk_size = chunk_size
+        self.count = 0
+
+    def add(self, stack):
+        raise NotImplementedError
+
+    def result(self):
+        raise NotImplementedError
+
+
+class MaximumReducer(Reducer):
+    """Keep the largest value of each pixel"""
+    ufunc = np.maximum
+
+    def __init__(self, shape, dtype, chunk_size=DEFAULT_CHUNK_SIZE):
+        Reducer.__init__(self, shape, dtype, chunk_size)
+        self.acc = np.empty(shape, self.dtype)
+        self.scratch = np.empty(shape, self.dtype)
+
+    def add(self, stack):
+        if self.count == 0:
+            self.ufunc.reduce(stack, axis=0, out=self.acc)
+        else:
+            self.ufunc.reduce(stack, axis=0, out=self.scratch)
+            self.ufunc(self.acc, self.scratch, out=self.acc)
+        self.count += len(stack)
+
+    def result(self):
+        return self.acc
+
+
+class MinimumReducer(MaximumReducer):
+    """Keep the smallest value of each pixel"""
+    ufunc = np.minimum
+
+
+class SumReducer(Reducer):
+    """Sum of each pixel, accumulated in float64 so it cannot overflow"""
+    out_dtype = np.float64
+
+    def __init__(self, shape, dtype, chunk_size=DEFAULT_CHUNK_SIZE):
+        Reducer.__init__(self, shape, dtype, chunk_size)
+        self.acc = np.zeros(shape, np.float64)
+
+    def add(self, stack):
+        for plane in stack:
+            np.add(self.acc, plane, out=self.acc)
+        self.count += len(stack)
 
+    def result(self):
+        return self.acc
 
-def planeGenerator(new_Z, C, T, Z, raw_pixel_store, pixels, projection, shape=None):
+
+class MeanReducer(SumReducer):
+    """Mean of each pixel, its float64 sum over the number of planes"""
+    out_dtype = np.float32
+
+    def result(self):
+        return (self.acc / self.count).astype(self.out_dtype)
+
+
+class StdDevReducer(Reducer):
+    """Running population standard deviation of each pixel (Welford)"""
+    out_dtype = np.float32
+
+    def __init__(self, shape, dtype, chunk_size=DEFAULT_CHUNK_SIZE):
+        Reducer.__init__(self, shape, dtype, chunk_size)
+        self.mean = np.zeros(shape, np.float64)
+        self.m2 = np.zeros(shape, np.float64)
+        self.delta = np.empty(shape, np.float64)
+
+    def add(self, stack):
+        for plane in stack:
+            self.count += 1
+            n = self.count
+            np.subtract(plane, self.mean, out=self.delta)
+            self.delta *= 1.0 / n
+            self.mean += self.delta
+            # (plane - old mean) * (plane - new mean) is n (n - 1) times
+            # the square of the step the mean just made
+            self.delta *= self.delta
+            self.delta *= n * (n - 1.0)
+            self.m2 += self.delta
+            self.update(plane)
+
+    def update(self, plane):
+        """Hook for subclasses, self.delta is free to use"""
+        pass
+
+    def result(self):
+        return np.sqrt(self.m2 / self.count).astype(self.out_dtype)
+
+
+class MedianReducer(StdDevReducer):
+    """
+    Median of each pixel. While the planes of the output fit in chunk_size
+    they are kept and the median is exact. Past that it is estimated by
+    stochastic approximation: the estimate moves towards every new value
+    by a step that shrinks with the running standard deviation over the
+    number of planes seen. That estimate lags behind on ordered input
+    such as a bleaching decay.
     """
-    Set up generator of 2D numpy arrays, each of which is a MIP
-    To be passed to createImage method so must be order z, c, t
+
+    def __init__(self, shape, dtype, chunk_size=DEFAULT_CHUNK_SIZE):
+        StdDevReducer.__init__(self, shape, dtype, chunk_size)
+        self.median = np.empty(shape, np.float64)
+        self.step = np.empty(shape, np.float64)
+        # Chunks kept until they no longer fit in chunk_size
+        self.chunks = []
+        self.buffered = 0
+
+    def add(self, stack):
+        if self.chunks is not None:
+            self.buffered += stack.nbytes
+            if self.buffered <= self.chunk_size:
+                # Copied when only part of a larger chunk, to free the rest
+                self.chunks.append(np.ascontiguousarray(stack))
+                return
+            chunks, self.chunks = self.chunks, None
+            for chunk in chunks:
+                StdDevReducer.add(self, chunk)
+        StdDevReducer.add(self, stack)
+
+    def update(self, plane):
+        if self.count == 1:
+            np.copyto(self.median, plane)
+            return
+        np.divide(self.m2, self.count - 1, out=self.step)
+        np.sqrt(self.step, out=self.step)
+        self.step *= 1.25 / self.count
+        np.subtract(plane, self.median, out=self.delta)
+        np.sign(self.delta, out=self.delta)
+        self.delta *= self.step
+        self.median += self.delta
+
+    def result(self):
+        if self.chunks is not None:
+            return np.median(np.concatenate(self.chunks), axis=0).astype(
+                self.out_dtype)
+        return self.median.astype(self.out_dtype)
+
+
+REDUCERS = {'Maximum': MaximumReducer,
+            'Minimum': MinimumReducer,
+            'Mean': MeanReducer,
+            'Sum': SumReducer,
+            'Standard_Deviation': StdDevReducer,
+            'Approximate_Median': MedianReducer}
+
+
+def planeGenerator(planes, raw_pixel_store, pixels, projection, shapes,
+                   chunk_size=DEFAULT_CHUNK_SIZE,
+                   read_ahead=DEFAULT_READ_AHEAD, use_tiles=False):
+    """
+    Set up generator of lists of 2D numpy arrays, one projection per shape,
+    for each of the output planes listed by outputPlanes, in that order.
+    The box of each group of nearby shapes from groupShapes is read once
+    per plane and each shape reduces its own part of it.
     """
-    for z in range(new_Z):  # createImageFromNumpySeq expects Z, C, T order
-        for c in range(C):
-            for t in range(T[0], T[1]):
-                for eachz in range(Z[0], Z[1]):
-                    plane = get_plane(raw_pixel_store, pixels, eachz, c, t)
-                    if shape is not None:
-                        plane = plane[shape['y']:shape['y']+shape['h'],
-                                      shape['x']:shape['x']+shape['w']]
-                    if eachz == Z[0]:
-                        new_plane = plane
-                    else:
-                        if projection == 'Maximum':
-                            # Replace pixel values if larger
-                            new_plane = np.where(np.greater(
-                                plane, new_plane), plane, new_plane)
-                        elif projection == 'Minimum':
-                            new_plane = np.where(
-                                np.less(plane, new_plane), plane, new_plane)
-                yield new_plane
+    dtype = get_dtype(pixels).newbyteorder('=')
+    groups = groupShapes(shapes)
+    boxes = dict((id(box), indices) for box, indices in groups)
+    jobs = [(plane, box) for plane in planes for box, indices in groups]
+    results = [None] * len(shapes)
+    done = 0
+    reducers = None
+    for job, stack in prefetch(readJobs(raw_pixel_store, pixels, jobs,
+                                        chunk_size, use_tiles), read_ahead):
+        box = job[1]
+        indices = boxes[id(box)]
+        if reducers is None:
+            reducers = [REDUCERS[projection]((shapes[i]['h'],
+                                              shapes[i]['w']), dtype,
+                                             chunk_size)
+                        for i in indices]
+        if stack is None:
+            for i, reducer in zip(indices, reducers):
+                results[i] = reducer.result()
+            reducers = None
+            done += 1
+            # Every group of the plane has been read
+            if done == len(groups):
+                yield results
+                results = [None] * len(shapes)
+                done = 0
+            continue
+        for i, reducer in zip(indices, reducers):
+            s = shapes[i]
+            x, y = s['x'] - box['x'], s['y'] - box['y']
+            reducer.add(stack[:, y:y+s['h'], x:x+s['w']])
+
+
+def iterTiles(shape, tile_w, tile_h):
+    """Split a shape into tiles, row by row"""
+    for y in range(0, shape['h'], tile_h):
+        for x in range(0, shape['w'], tile_w):
+            yield {'x': shape['x'] + x, 'y': shape['y'] + y,
+                   'w': min(tile_w, shape['w'] - x),
+                   'h': min(tile_h, shape['h'] - y)}
+
+
+def projectTiles(writer, planes, raw_pixel_store, pixels, projection,
+                 shape, tile_w, tile_h, chunk_size=DEFAULT_CHUNK_SIZE,
+                 use_tiles=False, read_ahead=DEFAULT_READ_AHEAD):
+    """
+    Project shape one tile at a time, writing every tile as soon as it is
+    reduced so memory is bounded by the tile size, not the plane size.
+    Planes and tiles are visited in the order pyramid writers need them.
+    """
+    dtype = get_dtype(pixels).newbyteorder('=')
+    # Pixels are stored XYZCT, so write planes with t slowest and z fastest
+    planes = sorted(planes, key=lambda plane: (plane[2], plane[1], plane[0]))
+    jobs = [(plane, tile) for plane in planes
+            for tile in iterTiles(shape, tile_w, tile_h)]
+    reducer = None
+    for ((z, c, t, Zr, Tr), tile), stack in prefetch(
+            readJobs(raw_pixel_store, pixels, jobs, chunk_size, use_tiles),
+            read_ahead):
+        if reducer is None:
+            reducer = REDUCERS[projection]((tile['h'], tile['w']), dtype,
+                                           chunk_size)
+        if stack is None:
+            writer.writeTile(reducer.result(), z, c, t,
+                             tile['x'] - shape['x'], tile['y'] - shape['y'])
+            reducer = None
+            continue
+        reducer.add(stack)
+
+
+class ImageWriter(object):
+    """
+    Create an image up front and stream its planes or tiles into it
+    through a raw pixels store, keeping the pixel type it was created with.
+    Planes that follow each other in the pixels (XYZCT order) are buffered
+    and written together with setRegion, up to buffer_size bytes at a time.
+    Writers can share a store for planes, but tiles are written straight
+    to the store as it was bound, so a tiled writer needs it to itself.
+    A shared writer whose output needs a pyramid opens a store of its own.
+    """
+
+    def __init__(self, conn, raw_pixel_store, name, desc, dataset,
+                 size_x, size_y, Z, C, T, dtype,
+                 buffer_size=DEFAULT_CHUNK_SIZE, shared=False):
+        self.conn = conn
+        self.raw_pixel_store = raw_pixel_store
+        self.name = name
+        self.size_x, self.size_y, self.Z, self.C = size_x, size_y, Z, C
+        self.dtype = np.dtype(dtype).newbyteorder('>')
+        self.plane_bytes = size_x * size_y * self.dtype.itemsize
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffer_start = 0
+        self.buffered = 0
+        # Bytes written and seconds spent writing them
+        self.bytes = 0
+        self.seconds = 0.0
+        pixels_type = conn.getQueryService().findByQuery(
+            "from PixelsType as p where p.value='%s'"
+            % PIXEL_TYPE_NAMES[np.dtype(dtype).type], None)
+        image_id = conn.getPixelsService().createImage(
+            size_x, size_y, Z, T, list(range(C)), pixels_type, name, desc,
+            conn.SERVICE_OPTS).getValue()
+        self.image = conn.getObject("Image", image_id)
+        self.pixels_id = self.image.getPixelsId()
+        self.bind()
+        self.pyramid = raw_pixel_store.requiresPixelsPyramid()
+        self.own_store = self.pyramid and shared
+        if self.own_store:
+            self.raw_pixel_store = conn.c.sf.createRawPixelsStore()
+            self.bind()
+        self.tile_size = self.raw_pixel_store.getTileSize()
+        self.minmax = {}
+        if dataset is not None:
+            link = omero.model.DatasetImageLinkI()
+            link.setParent(omero.model.DatasetI(dataset.getId(), False))
+            link.setChild(omero.model.ImageI(image_id, False))
+            conn.getUpdateService().saveObject(link)
+
+    def bind(self):
+        self.raw_pixel_store.setPixelsId(self.pixels_id, True)
+
+    def updateMinMax(self, data, the_c):
+        low, high = data.min(), data.max()
+        if the_c in self.minmax:
+            low = min(low, self.minmax[the_c][0])
+            high = max(high, self.minmax[the_c][1])
+        self.minmax[the_c] = (low, high)
+
+    def writeTile(self, tile, the_z, the_c, the_t, x, y):
+        h, w = tile.shape
+        data = tile.astype(self.dtype).tobytes()
+        start = time.time()
+        self.raw_pixel_store.setTile(data, the_z, the_c, the_t, x, y, w, h)
+        self.seconds += time.time() - start
+        self.bytes += len(data)
+        self.updateMinMax(tile, the_c)
+
+    def writePlane(self, plane, the_z, the_c, the_t):
+        if self.pyramid:
+            # Pyramids are only written tile by tile, in order
+            whole = {'x': 0, 'y': 0, 'w': self.size_x, 'h': self.size_y}
+            for tile in iterTiles(whole, *self.tile_size):
+                self.writeTile(plane[tile['y']:tile['y']+tile['h'],
+                                     tile['x']:tile['x']+tile['w']],
+                               the_z, the_c, the_t, tile['x'], tile['y'])
+            return
+        offset = (the_z + self.Z * (the_c + self.C * the_t)) * \
+            self.plane_bytes
+        if self.buffer and offset != self.buffer_start + self.buffered:
+            self.flush()
+        if not self.buffer:
+            self.buffer_start = offset
+        self.buffer.append(plane.astype(self.dtype).tobytes())
+        self.buffered += self.plane_bytes
+        self.updateMinMax(plane, the_c)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered planes in one request"""
+        if not self.buffer:
+            return
+        start = time.time()
+        self.bind()
+        self.raw_pixel_store.setRegion(self.buffered, self.buffer_start,
+                                       b''.join(self.buffer))
+        self.seconds += time.time() - start
+        self.bytes += self.buffered
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        """Write what is left and save the pixels, returns the new image"""
+        self.flush()
+        self.bind()
+        self.raw_pixel_store.save()
+        if self.own_store:
+            self.raw_pixel_store.close()
+        log("%s: wrote %.1f MB in %.1f s (%.1f MB/s)" % (
+            self.name, self.bytes / 1e6, self.seconds,
+            self.bytes / 1e6 / max(self.seconds, 1e-6)))
+        return self.image
+
+
+def getRectangles(conn, images):
+    """
+    Rectangle shapes of every image, loaded in one query per chunk of IDs
+    """
+    query_service = conn.getQueryService()
+    rectangles = dict((image.getId(), []) for image in images)
+    for chunk in chunks(list(rectangles)):
+        params = ParametersI()
+        params.addIds(chunk)
+        for roi in query_service.findAllByQuery(
+                "select distinct r from Roi r join fetch r.shapes "
+                "where r.image.id in (:ids)", params, conn.SERVICE_OPTS):
+            for s in roi.copyShapes():
+                if type(s) == omero.model.RectangleI:
+                    rectangles[roi.getImage().getId().getValue()].append(s)
+    return rectangles
+
+
+def getRanges(image, script_params):
+    """Z and T ranges to project, as [first, last + 1]"""
+    Z, T = image.getSizeZ(), image.getSizeT()
+    if "First_Z" in script_params:
+        Z1 = [script_params["First_Z"]-1, Z]
+    else:
+        Z1 = [0, Z]
+    if "Last_Z" in script_params:
+        Z1[1] = script_params["Last_Z"]
+    if "First_T" in script_params:
+        T1 = [script_params["First_T"]-1, T]
+    else:
+        T1 = [0, T]
+    if "Last_T" in script_params:
+        T1[1] = script_params["Last_T"]
+    return Z1, T1
+
+
+def getFingerprint(image, script_params, shape):
+    """
+    Identify a projection by its source pixels and their last update,
+    and by everything in the parameters that changes the result
+    """
+    pixels = image._obj.getPrimaryPixels()
+    Z1, T1 = getRanges(image, script_params)
+    key = "%s:%s:%s:%s:%s-%s:%s-%s:%s,%s,%s,%s:%s" % (
+        pixels.getId().getValue(),
+        pixels.getDetails().getUpdateEvent().getId().getValue(),
+        script_params["Method"], script_params["Axis"], Z1[0], Z1[1],
+        T1[0], T1[1], shape['x'], shape['y'], shape['w'], shape['h'],
+        script_params["Resolution_Level"])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def findFingerprints(conn, fingerprints):
+    """
+    Fingerprints that already annotate a projected image, looked up in one
+    query per chunk
+    """
+    query_service = conn.getQueryService()
+    found = set()
+    for chunk in chunks(list(fingerprints)):
+        params = ParametersI()
+        params.add("ns", rstring(FINGERPRINT_NS))
+        params.add("values", rlist([rstring(fp) for fp in chunk]))
+        rows = query_service.projection(
+            "select distinct mv.value from MapAnnotation a "
+            "join a.mapValue mv, ImageAnnotationLink l "
+            "where l.child.id = a.id and a.ns = :ns "
+            "and mv.name = 'fingerprint' and mv.value in (:values)",
+            params, conn.SERVICE_OPTS)
+        found.update(row[0].getValue() for row in rows)
+    return found
+
+
+def fingerprintLink(newImage, image, script_params, fingerprint, level):
+    """Unsaved link of a map annotation recording how newImage was made"""
+    Z1, T1 = getRanges(image, script_params)
+    ann = omero.model.MapAnnotationI()
+    ann.setNs(rstring(FINGERPRINT_NS))
+    ann.setMapValue([
+        omero.model.NamedValue('fingerprint', fingerprint),
+        omero.model.NamedValue('source_image', str(image.getId())),
+        omero.model.NamedValue('method', script_params["Method"]),
+        omero.model.NamedValue('axis', script_params["Axis"]),
+        omero.model.NamedValue('z', "%s-%s" % (Z1[0] + 1, Z1[1])),
+        omero.model.NamedValue('t', "%s-%s" % (T1[0] + 1, T1[1])),
+        omero.model.NamedValue('resolution_level', str(level))])
+    link = omero.model.ImageAnnotationLinkI()
+    link.setParent(omero.model.ImageI(newImage.getId(), False))
+    link.setChild(ann)
+    return link
+
+
+def getTargets(image, rectangles, script_params):
+    """
+    List (shape, name, description, fingerprint) of every output to make
+    from image
+    """
+    targets = []
+    axis = script_params["Axis"]
+    # Z projections keep their original names
+    suffix = "" if axis == 'Z' else "_" + axis
+    if script_params["Resolution_Level"]:
+        suffix += "_level%s" % script_params["Resolution_Level"]
+    if script_params["Apply_to_ROIs_only"]:
+        for s in rectangles:
+            shape = clipShape(getRoiShape(s), image.getSizeX(),
+                              image.getSizeY())
+            if shape is None:
+                continue
+            name = "%s_%s_%s%s" % (image.getName(), s.getId().getValue(),
+                                   script_params["Method"], suffix)
+            desc = ("%s intensity %s projection of\
+                    Image ID: %s, shape ID: %s"
+                    % (script_params["Method"], axis, image.getId(),
+                       s.getId().getValue()))
+            targets.append((shape, name, desc))
+    else:
+        shape = {}
+        shape['x'] = 0
+        shape['y'] = 0
+        shape['w'] = image.getSizeX()
+        shape['h'] = image.getSizeY()
+        name = "%s_%s%s" % (image.getName(), script_params["Method"], suffix)
+        desc = ("%s intensity %s projection of Image ID: \
+                 %s" % (script_params["Method"], axis, image.getId()))
+        targets.append((shape, name, desc))
+    return [(shape, name, desc, getFingerprint(image, script_params, shape))
+            for shape, name, desc in targets]
+
+
+def projectImage(conn, image, targets, dataset, script_params, store_pool):
+    """
+    Make the projections of one image listed by getTargets, with the
+    parameters given to getTargets. Returns a dict for each with the new
+    image, its fingerprint, the scale of output to source pixels, the
+    range of every channel and the resolution level read, for
+    copyMetadata.
+    """
+    new_images = []
+    C = image.getSizeC()
+    Z1, T1 = getRanges(image, script_params)
+    # Loaded with its pixels type by getImages
+    pixels = image._obj.getPrimaryPixels()
+    # Pixels are stored XYZCT, so make planes with t slowest and z fastest
+    planes = sorted(outputPlanes(script_params["Axis"], Z1, C, T1),
+                    key=lambda plane: (plane[2], plane[1], plane[0]))
+    new_Z = Z1[1]-Z1[0] if script_params["Axis"] == 'T' else 1
+    new_T = T1[1]-T1[0] if script_params["Axis"] == 'Z' else 1
+    out_dtype = (REDUCERS[script_params["Method"]].out_dtype
+                 or get_dtype(pixels).newbyteorder('='))
+    with store_pool.acquire() as raw_pixel_store, \
+            store_pool.acquire() as write_store:
+        # Get planes as numpy arrays
+        size_x, size_y = bind_store(raw_pixel_store, pixels,
+                                    script_params["Resolution_Level"])
+        scale = (float(size_x) / image.getSizeX(),
+                 float(size_y) / image.getSizeY())
+        if scale != (1.0, 1.0):
+            # Previews read a smaller level, shapes are in full size pixels
+            targets = [(scaleShape(shape, scale[0], scale[1], size_x,
+                                   size_y), name, desc, fingerprint)
+                       for shape, name, desc, fingerprint in targets]
+        pyramid = raw_pixel_store.requiresPixelsPyramid()
+        writers = []
+        # Only full size pyramid levels are too big for whole planes
+        if script_params["Tile_Size"] or (pyramid and scale == (1.0, 1.0)):
+            for shape, name, desc, fingerprint in targets:
+                writer = ImageWriter(
+                    conn, write_store, name, desc, dataset, shape['w'],
+                    shape['h'], new_Z, C, new_T, out_dtype)
+                if writer.pyramid or not script_params["Tile_Size"]:
+                    # Pyramid writers only take their own tile size
+                    tile_w, tile_h = writer.tile_size
+                else:
+                    tile_w = tile_h = script_params["Tile_Size"]
+                projectTiles(writer, planes, raw_pixel_store, pixels,
+                             script_params["Method"], shape, tile_w,
+                             tile_h, script_params["Chunk_Size"],
+                             pyramid, script_params["Read_Ahead"])
+                writer.close()
+                writers.append(writer)
+        else:
+            # All outputs share the write buffer space of one chunk
+            buffer_size = script_params["Chunk_Size"] // len(targets)
+            writers = [ImageWriter(conn, write_store, name, desc, dataset,
+                                   shape['w'], shape['h'], new_Z, C, new_T,
+                                   out_dtype, buffer_size, shared=True)
+                       for shape, name, desc, fingerprint in targets]
+            results = planeGenerator(planes, raw_pixel_store, pixels,
+                                     script_params["Method"],
+                                     [target[0] for target in targets],
+                                     script_params["Chunk_Size"],
+                                     script_params["Read_Ahead"], pyramid)
+            for (z, c, t, Zr, Tr), result in zip(planes, results):
+                for writer, plane in zip(writers, result):
+                    writer.writePlane(plane, z, c, t)
+            for writer in writers:
+                writer.close()
+    for writer, target in zip(writers, targets):
+        new_images.append({'image': writer.image, 'fingerprint': target[3],
+                           'scale': scale, 'minmax': writer.minmax,
+                           'level': script_params["Resolution_Level"]})
+    return new_images
+
+
+class StorePool(object):
+    """
+    Fixed set of raw pixels stores, opened once, shared by the workers
+    and closed together at the end
+    """
+
+    def __init__(self, conn, size):
+        self.stores = [conn.c.sf.createRawPixelsStore() for i in range(size)]
+        self.free = queue.Queue()
+        for store in self.stores:
+            self.free.put(store)
+
+    @contextmanager
+    def acquire(self):
+        store = self.free.get()
+        try:
+            yield store
+        finally:
+            self.free.put(store)
+
+    def close(self):
+        for store in self.stores:
+            try:
+                store.close()
+            except Exception as e:
+                log("Could not close raw pixels store: %s" % e)
 
 
 def create_new_dataset(conn, name):
@@ -115,10 +1020,11 @@ def create_new_dataset(conn, name):
 
 def runScript():
     dataTypes = [rstring('Dataset'), rstring('Image')]
-    projections = [rstring('Maximum'), rstring('Minimum')]
+    projections = [rstring(method) for method in REDUCERS]
+    axes = [rstring('Z'), rstring('T'), rstring('ZT')]
     client = scripts.client(
         "Intensity_Projection.py", """Creates a new image of the selected \
-        intensity projection in Z from an existing image""",
+        intensity projection in Z, T or both from an existing image""",
         scripts.String(
             "Data_Type", optional=False, grouping="01", values=dataTypes,
             default="Image"),
@@ -127,8 +1033,16 @@ def runScript():
             description="""IDs of the images to project""").ofType(rlong(0)),
         scripts.String(
             "Method", grouping="03",
-            description="""Type of projection to run""", values=projections,
+            description="""Type of projection to run. Approximate_Median \
+            is exact when the planes of one output fit in Chunk_Size, and \
+            an estimate otherwise that can be far off when values rise or \
+            fall steadily along the stack, such as bleaching along T""",
+            values=projections,
             default='Maximum'),
+        scripts.String(
+            "Axis", grouping="14", values=axes, default='Z',
+            description="""Dimension to project along, Z, T or both. The \
+            Z and T ranges below select the planes used either way"""),
         scripts.Int(
             "First_Z", grouping="04", min=1,
             description="First Z plane to project, default is first plane"),
@@ -143,12 +1057,38 @@ def runScript():
             description="Last T plane to project, default is last plane"),
         scripts.Bool(
             "Apply_to_ROIs_only", grouping="08", default=False,
-            description="Apply maximum projection only to rectangular ROIs, \
+            description="Apply projection only to rectangular ROIs, \
             if not rectangular ROIs found, image will be skipped"),
         scripts.String(
             "Dataset_Name", grouping="09",
             description="To save projections to new dataset, enter it's name. \
             To save projections to existing dataset, leave blank"),
+        scripts.Long(
+            "Chunk_Size", grouping="10", min=1, default=DEFAULT_CHUNK_SIZE,
+            description="Maximum number of bytes to fetch from the server \
+            in one request, several Z planes are read at once if they fit"),
+        scripts.Int(
+            "Tile_Size", grouping="11", min=0, default=0,
+            description="Project and write tiles of this width and height \
+            one at a time to bound memory on large images. 0 projects whole \
+            planes, except for pyramidal images which are always tiled"),
+        scripts.Int(
+            "Max_Workers", grouping="12", min=1, default=4,
+            description="Number of images to project at the same time"),
+        scripts.Int(
+            "Read_Ahead", grouping="13", min=0, default=DEFAULT_READ_AHEAD,
+            description="Number of chunks to download in the background \
+            while the current one is projected, 0 to turn off. Each one \
+            holds up to Chunk_Size bytes"),
+        scripts.Bool(
+            "Force_Recompute", grouping="15", default=False,
+            description="Project again even if a projection with the same \
+            source, pixels and parameters was already made"),
+        scripts.Int(
+            "Resolution_Level", grouping="16", min=0, default=0,
+            description="Preview pyramidal images at a lower resolution, \
+            0 is full size and each level above it is smaller. Images \
+            without a pyramid are projected at full size"),
 
         version="0.5",
         authors=["Laura Cooper", "CAMDU"],
@@ -162,73 +1102,111 @@ def runScript():
         images = getImages(conn, script_params)
         user = conn.getUser().getName()
 
-        # Create new dataset if Dataset_Name is defined
-        if "Dataset_Name" in script_params:
+        # Work out every output up front to skip those already made
+        rectangles = {}
+        if script_params["Apply_to_ROIs_only"]:
+            rectangles = getRectangles(conn, images)
+        # Parameters of each image, with the resolution level it is read at
+        levels = getLevels(conn, images, script_params["Resolution_Level"])
+        image_params = dict(
+            (image.getId(),
+             dict(script_params, Resolution_Level=levels[image.getId()]))
+            for image in images)
+        targets = {}
+        for image in images:
+            Z1, T1 = getRanges(image, script_params)
+            # Skip image if Z dimension is 1 or if given Z range is less
+            # than 1
+            if not ((image.getSizeZ() != 1) or ((Z1[1]-Z1[0]) >= 1)):
+                continue
+            # An empty range would leave the reducers with nothing to
+            # reduce
+            if Z1[1] <= Z1[0] or T1[1] <= T1[0]:
+                log("Empty Z or T range on image %s, skipping"
+                    % image.getId())
+                continue
+            targets[image.getId()] = getTargets(
+                image, rectangles.get(image.getId(), []),
+                image_params[image.getId()])
+            if not targets[image.getId()]:
+                log("No rectangle ROIs on image %s, skipping" % image.getId())
+        if not script_params["Force_Recompute"]:
+            done = findFingerprints(conn, [
+                target[3] for image_targets in targets.values()
+                for target in image_targets])
+            if done:
+                log("Skipping %d projection(s) already made, use "
+                    "Force_Recompute to make them again" % len(done))
+            for image_id in targets:
+                targets[image_id] = [target for target in targets[image_id]
+                                     if target[3] not in done]
+        images = [image for image in images if targets.get(image.getId())]
+
+        # Create new dataset if Dataset_Name is defined and there is work
+        if "Dataset_Name" in script_params and images:
             new_dataset = create_new_dataset(conn,
                                              script_params["Dataset_Name"])
 
+        # Output dataset of each image, sorted out before any work starts
+        datasets = {}
+        # One copy per dataset not owned by the user
+        copies = {}
         for image in images:
             # If Dataset_Name empty user existing, use new one if not.
             if "Dataset_Name" in script_params:
-                dataset = new_dataset
+                datasets[image.getId()] = new_dataset
             else:
-                dataset = image.getParent()
-                if dataset.getOwnerOmeName() != user:
-                    dataset = create_new_dataset(conn, dataset.getName())
-            Z, C, T = image.getSizeZ(), image.getSizeC(), image.getSizeT()
-            if "First_Z" in script_params:
-                Z1 = [script_params["First_Z"]-1, Z]
-            else:
-                Z1 = [0, Z]
-            if "Last_Z" in script_params:
-                Z1[1] = script_params["Last_Z"]
-            if "First_T" in script_params:
-                T1 = [script_params["First_T"]-1, T]
-            else:
-                T1 = [0, T]
-            if "Last_T" in script_params:
-                T1[1] = script_params["Last_T"]
-            # Skip image if Z dimension is 1 or if given Z range is less than 1
-            if (Z != 1) or ((Z1[1]-Z1[0]) >= 1):
-                # Get plane as numpy array
-                raw_pixel_store = conn.c.sf.createRawPixelsStore()
-                query_service = conn.getQueryService()
-                query_string = "select p from Pixels p join fetch p.image i "\
-                    "join fetch p.pixelsType pt where i.id='%d'" % image.getId()
-                pixels = query_service.findByQuery(query_string, None)
-                if script_params["Apply_to_ROIs_only"]:
-                    roi_service = conn.getRoiService()
-                    result = roi_service.findByImage(image.getId(), None)
-                    if result is not None:
-                        for roi in result.rois:
-                            for s in roi.copyShapes():
-                                if type(s) == omero.model.RectangleI:
-                                    shape = getRoiShape(s)
-                                    name = "%s_%s_%s" % (image.getName(),
-                                                         s.getId().getValue(),
-                                                         script_params["Method"])
-                                    desc = ("%s intensity Z projection of\
-                                            Image ID: %s, shape ID: %s"
-                                            % (script_params["Method"],
-                                               image.getId(),
-                                               s.getId().getValue()))
+                dataset = getDataset(conn, image)
+                if dataset is not None and dataset.getOwnerOmeName() != user:
+                    if dataset.getId() not in copies:
+                        copies[dataset.getId()] = create_new_dataset(
+                            conn, dataset.getName())
+                    dataset = copies[dataset.getId()]
+                datasets[image.getId()] = dataset
+
+        # Stores are shared by the workers, each needs at most two at once
+        store_pool = StorePool(conn, 2 * script_params["Max_Workers"])
+        # Projections from projectImage waiting for their metadata
+        pending = []
+        pool = ThreadPoolExecutor(script_params["Max_Workers"])
+        futures = {}
+
+        def collect(future):
+            """Move the outputs of a finished image into pending"""
+            image = futures.pop(future)
+            for output in future.result():
+                output['source'] = image
+                pending.append(output)
+                client.setOutput("New Image", robject(output['image']._obj))
+
+        try:
+            for image in images:
+                futures[pool.submit(projectImage, conn, image,
+                                    targets[image.getId()],
+                                    datasets[image.getId()],
+                                    image_params[image.getId()],
+                                    store_pool)] = image
+            for future in as_completed(list(futures)):
+                collect(future)
+                # Record finished projections regularly so an
+                # interrupted run can be resumed
+                if len(pending) >= METADATA_BATCH_SIZE:
+                    copyMetadata(conn, pending, script_params)
+                    pending = []
+        finally:
+            # After a failure, images not started yet are dropped and
+            # those already running are waited for
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=True)
+            for future in list(futures):
+                if future.cancelled() or future.exception() is not None:
+                    futures.pop(future)
                 else:
-                    shape = {}
-                    shape['x'] = 0
-                    shape['y'] = 0
-                    shape['w'] = image.getSizeX()
-                    shape['h'] = image.getSizeY()
-                    name = "%s_%s" % (
-                        image.getName(), script_params["Method"])
-                    desc = ("%s intensity Z projection of Image ID: \
-                             %s" % (script_params["Method"],
-                                    image.getId()))
-                newImage = conn.createImageFromNumpySeq(
-                    planeGenerator(1, C, T1, Z1, raw_pixel_store, pixels,
-                                   script_params["Method"], shape),
-                    name, 1, C, T1[1]-T1[0], description=desc, dataset=dataset)
-                copyMetadata(conn, newImage, image)
-                client.setOutput("New Image", robject(newImage._obj))
+                    collect(future)
+            store_pool.close()
+            # Metadata of the remaining projections is written back too
+            copyMetadata(conn, pending, script_params)
 
     finally:
         # Cleanup